@@ -1,27 +1,110 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Response, status
-from PIL import Image
-from rembg import remove
-import io
+import os
+import asyncio
+from typing import Optional
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Header, Query
 from fastapi.responses import StreamingResponse
-from fastapi.staticfiles import StaticFiles
-from fastapi.security import HTTPBearer
-from utils import VerifyToken
+from PIL import Image
+from dotenv import load_dotenv
+from app.models.background_removal import remove_background as remove, resolve_model_name, UnknownModelError
+from app.utils.utils import requires_auth
+from app.utils.ingest import decode_image
+from app.utils.streaming import stream_encoded
+from app.utils.uploads import read_upload, UploadError, UploadLimitMiddleware
+
+load_dotenv()
+CUTOUT_PNG_COMPRESS_LEVEL = int(os.getenv('CUTOUT_PNG_COMPRESS_LEVEL', 6))
+CUTOUT_WEBP_QUALITY = int(os.getenv('CUTOUT_WEBP_QUALITY', 80))
+# 0 is fastest, 6 smallest
+CUTOUT_WEBP_METHOD = int(os.getenv('CUTOUT_WEBP_METHOD', 4))
+# Alpha at or below this counts as background when cropping to the foreground
+CROP_ALPHA_THRESHOLD = int(os.getenv('CROP_ALPHA_THRESHOLD', 8))
+
+MEDIA_TYPES = {'png': 'image/png', 'webp': 'image/webp'}
 
 app = FastAPI()
-token_auth_scheme = HTTPBearer()
+app.add_middleware(UploadLimitMiddleware)
+
+
+def negotiate_format(requested, accept):
+    if requested:
+        if requested not in MEDIA_TYPES:
+            raise HTTPException(status_code=400, detail="format must be png or webp")
+        return requested
+    # Clients that say they take WebP get it, everything else keeps getting PNG
+    return 'webp' if accept and 'image/webp' in accept else 'png'
+
+
+def foreground_box(alpha):
+    """Bounding box of the pixels above CROP_ALPHA_THRESHOLD, None when there are none"""
+    table = [0] * (CROP_ALPHA_THRESHOLD + 1) + [255] * (255 - CROP_ALPHA_THRESHOLD)
+    return alpha.point(table).getbbox()
+
+
+def shape_cutout(image, crop=False, max_side=None):
+    """Crops to the foreground and downscales, returns (image, crop box or None)"""
+    box = None
+    if crop:
+        box = foreground_box(image if image.mode == 'L' else image.getchannel('A'))
+        if box is not None:
+            image = image.crop(box)
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.BILINEAR)
+    return image, box
+
+
+def make_cutout(contents, bg_model=None, mask=False, crop=False, max_side=None):
+    # Without a crop the output can't be larger than max_side, so decode no larger than that.
+    # A crop keeps full resolution until the foreground box is known.
+    input_image = decode_image(contents, max_side=None if crop else max_side)
+    # only_mask skips compositing the RGBA cutout when only the mask is wanted
+    output_image = remove(input_image, model=bg_model, only_mask=mask)
+    return shape_cutout(output_image, crop, max_side)
+
+
+def encode_cutout(fp, image, image_format, lossless, quality, compress_level):
+    if image_format == 'webp':
+        # For lossless WebP quality is the compression effort, the pixels are exact either way
+        image.save(fp, format='WEBP', lossless=lossless, quality=quality, method=CUTOUT_WEBP_METHOD)
+    else:
+        image.save(fp, format='PNG', compress_level=compress_level)
+
 
 @app.put("/remove_background")
-async def remove_background( file: UploadFile = File(...)):
-    result = VerifyToken(token).verify()
-    if not result.get("status"):
-       return Response(status_code=status.HTTP_400_BAD_REQUEST)
+async def remove_background(file: UploadFile = File(...), bg_model: str = None,
+                            output_format: Optional[str] = Query(None, alias='format'),
+                            lossless: bool = True, quality: int = CUTOUT_WEBP_QUALITY, mask: bool = False,
+                            crop: bool = False, max_side: Optional[int] = None,
+                            compress_level: int = CUTOUT_PNG_COMPRESS_LEVEL, accept: Optional[str] = Header(None),
+                            claims: dict = Depends(requires_auth)):
+    """Returns the cutout, or with mask=true only its alpha mask as a grayscale image.
+    format picks png or webp (lossless unless lossless=false, then at quality); without it the
+    Accept header decides. crop=true trims to the foreground box, reported in X-Crop-Box, and
+    max_side caps the longest side of what is returned."""
+    image_format = negotiate_format(output_format, accept)
+    if not 1 <= quality <= 100:
+        raise HTTPException(status_code=400, detail="quality must be between 1 and 100")
+    if not 0 <= compress_level <= 9:
+        raise HTTPException(status_code=400, detail="compress_level must be between 0 and 9")
+    if max_side is not None and max_side < 1:
+        raise HTTPException(status_code=400, detail="max_side must be positive")
+    if bg_model:
+        try:
+            resolve_model_name(bg_model)
+        except UnknownModelError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     try:
-        contents = await file.read()
-        input_image = Image.open(io.BytesIO(contents))
-        output_image = remove(input_image)
-        output_bytes = io.BytesIO()
-        output_image.save(output_bytes, format="PNG")
-        output_bytes.seek(0)
-        return StreamingResponse(output_bytes, media_type="image/png")
+        contents = await read_upload(file)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    try:
+        output_image, box = await asyncio.to_thread(make_cutout, contents, bg_model, mask, crop, max_side)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+
+    headers = {"Vary": "Accept"}
+    if crop:
+        headers["X-Crop-Box"] = ','.join(str(v) for v in box) if box else ''
+    # The encoder writes straight into the response body, no full copy is buffered first
+    return StreamingResponse(stream_encoded(encode_cutout, output_image, image_format, lossless, quality,
+                                            compress_level),
+                             media_type=MEDIA_TYPES[image_format], headers=headers)
@@ -0,0 +1,135 @@
+import os
+import json
+import mmap
+import asyncio
+import zipfile
+from io import BytesIO
+from dotenv import load_dotenv
+from app.api.pipeline import recognize_cached
+from app.utils.executor import pipeline_executor
+from app.utils.uploads import check_image, UploadError, MAX_UPLOAD_BYTES, BATCH_MAX_UPLOAD_BYTES
+
+load_dotenv()
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 300))
+# Items of one batch in flight at once, the rest wait so a batch can't starve other requests
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', pipeline_executor.max_workers))
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+
+class BatchTooLargeError(ValueError):
+    """Raised when a batch holds more images than BATCH_MAX_ITEMS, or more bytes than BATCH_MAX_UPLOAD_BYTES"""
+
+
+def _detach(fileobj):
+    """A handle of our own on an upload, so items can be read after the request's file objects are closed"""
+    if getattr(fileobj, '_rolled', False):
+        # Same spooled file on disk, nothing is copied
+        return open(os.dup(fileobj.fileno()), 'rb')
+    fileobj.seek(0)
+    return BytesIO(fileobj.read())
+
+
+def _file_loader(handle, size):
+    def load():
+        if isinstance(handle, BytesIO):
+            data = handle.getvalue()
+        else:
+            data = mmap.mmap(handle.fileno(), size, access=mmap.ACCESS_READ)
+        check_image(data)
+        if not isinstance(data, bytes):
+            data.seek(0)
+        return data
+    return load
+
+
+def _zip_loader(archive, info):
+    def load():
+        # zipfile stops at the declared file_size, which was already counted against the batch limit
+        data = archive.read(info)
+        check_image(data)
+        return data
+    return load
+
+
+def iter_zip_images(fileobj):
+    """Yields (filename, size, loader or error) for every image inside a zip archive.
+    Nothing is inflated here, each loader extracts its member when it is called."""
+    archive = zipfile.ZipFile(fileobj)
+    for info in archive.infolist():
+        name = os.path.basename(info.filename)
+        if info.is_dir() or name.startswith('.') or not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        if info.file_size > MAX_UPLOAD_BYTES:
+            yield info.filename, 0, UploadError(413, f"Image is larger than {MAX_UPLOAD_BYTES} bytes")
+            continue
+        yield info.filename, info.file_size, _zip_loader(archive, info)
+
+
+def collect_items(uploads):
+    """Turns uploaded files and zip archives into a flat list of (filename, loader or error).
+    Only sizes and zip directories are read here; loaders read an image when it is processed,
+    so a batch never holds more than BATCH_CONCURRENCY images in memory."""
+    items = []
+    total = 0
+
+    def add(filename, size, loader):
+        nonlocal total
+        if len(items) >= BATCH_MAX_ITEMS:
+            raise BatchTooLargeError(f'A batch can hold at most {BATCH_MAX_ITEMS} images')
+        total += size
+        if total > BATCH_MAX_UPLOAD_BYTES:
+            # Counts declared sizes of zip members too, so a small archive can't inflate past the limit
+            raise BatchTooLargeError(f'A batch can hold at most {BATCH_MAX_UPLOAD_BYTES} bytes of images')
+        items.append((filename, loader))
+
+    for filename, fileobj in uploads:
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+        # The handles are closed once the loaders holding them are dropped
+        handle = _detach(fileobj)
+        if (filename or '').lower().endswith('.zip'):
+            try:
+                for member in iter_zip_images(handle):
+                    add(*member)
+            except zipfile.BadZipFile as e:
+                add(filename, 0, e)
+        elif size > MAX_UPLOAD_BYTES:
+            add(filename, 0, UploadError(413, f"Image is larger than {MAX_UPLOAD_BYTES} bytes"))
+        elif not size:
+            add(filename, 0, UploadError(400, "Empty file"))
+        else:
+            add(filename, size, _file_loader(handle, size))
+    return items
+
+
+async def _process_item(index, filename, loader, bg_model, annotate, limit):
+    line = {"index": index, "filename": filename}
+    if isinstance(loader, Exception):
+        line.update(status="error", error=str(loader))
+        return line
+    async with limit:
+        try:
+            # Read inside the limit, so only the items being processed are in memory
+            data = await asyncio.to_thread(loader)
+            result, _, _ = await recognize_cached(data, bg_model, annotate, path='batch')
+            line.update(status="ok", result=result)
+        except Exception as e:
+            line.update(status="error", error=str(e))
+    return line
+
+
+async def stream_batch(items, bg_model=None, annotate=False, concurrency=BATCH_CONCURRENCY):
+    """Yields one NDJSON line per item as soon as it finishes, in completion order"""
+    limit = asyncio.Semaphore(concurrency)
+    tasks = [asyncio.ensure_future(_process_item(i, filename, loader, bg_model, annotate, limit))
+             for i, (filename, loader) in enumerate(items)]
+    # Drop our references so each image's handles and bytes can be freed once it is processed
+    items.clear()
+    try:
+        for task in asyncio.as_completed(tasks):
+            line = await task
+            yield json.dumps(line) + '\n'
+    finally:
+        for task in tasks:
+            task.cancel()
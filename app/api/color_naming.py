@@ -0,0 +1,86 @@
+import os
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+load_dotenv()
+COLOR_NAMING_SPACE = os.getenv('COLOR_NAMING_SPACE', 'lab')
+# Bits kept per channel in the lookup table, 0 compares against every named color instead
+COLOR_NAMING_LUT_BITS = int(os.getenv('COLOR_NAMING_LUT_BITS', 5))
+
+index = ['color', 'color_name', 'hex', 'R', 'G', 'B']
+
+
+def srgb_to_lab(rgb):
+    """Converts an (..., 3) array of 0-255 sRGB values to CIELAB (D65)"""
+    rgb = np.asarray(rgb, dtype=np.float32) / 255.0
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = linear @ np.array([[0.4124, 0.2126, 0.0193],
+                             [0.3576, 0.7152, 0.1192],
+                             [0.1805, 0.0722, 0.9505]], dtype=np.float32)
+    xyz /= np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16.0 / 116.0)
+    l = 116.0 * f[..., 1] - 16.0
+    a = 500.0 * (f[..., 0] - f[..., 1])
+    b = 200.0 * (f[..., 1] - f[..., 2])
+    return np.stack([l, a, b], axis=-1)
+
+
+def hex_to_rgb_array(hex_colors):
+    return np.array([[int(h.lstrip('#')[i:i + 2], 16) for i in (0, 2, 4)] for h in hex_colors], dtype=np.uint8)
+
+
+class ColorNamer():
+    """Names RGB colors after their nearest entry in the colors CSV"""
+
+    def __init__(self, csv_path, space=COLOR_NAMING_SPACE, lut_bits=COLOR_NAMING_LUT_BITS):
+        color_df = pd.read_csv(csv_path, names=index, header=None)
+        self.names = color_df['color_name'].to_numpy()
+        self.hex = color_df['hex'].to_numpy()
+        self.rgb = color_df[['R', 'G', 'B']].to_numpy(dtype=np.uint8)
+        self.space = space
+        self._features = self._to_space(self.rgb)
+        self.lut_bits = lut_bits
+        self._lut = self._build_lut(lut_bits) if lut_bits else None
+
+    def _to_space(self, rgb):
+        if self.space == 'lab':
+            return srgb_to_lab(rgb)
+        return np.asarray(rgb, dtype=np.float32)
+
+    def _nearest(self, rgb, chunk_size=4096):
+        rgb = np.asarray(rgb).reshape(-1, 3)
+        out = np.empty(len(rgb), dtype=np.int32)
+        features = self._features
+        features_sq = (features ** 2).sum(1)
+        for start in range(0, len(rgb), chunk_size):
+            query = self._to_space(rgb[start:start + chunk_size])
+            # |q - f|^2 without the |q|^2 term, which does not change the argmin
+            distances = features_sq[None, :] - 2.0 * query @ features.T
+            out[start:start + chunk_size] = distances.argmin(1)
+        return out
+
+    def _build_lut(self, bits):
+        # Evaluate every quantized color once at the center of its cell
+        levels = 1 << bits
+        step = 256 // levels
+        centers = np.arange(levels, dtype=np.uint16) * step + step // 2
+        grid = np.stack(np.meshgrid(centers, centers, centers, indexing='ij'), axis=-1)
+        return self._nearest(grid.reshape(-1, 3)).astype(np.uint16)
+
+    def nearest_indices(self, rgb):
+        rgb = np.asarray(rgb, dtype=np.uint8).reshape(-1, 3)
+        if self._lut is None:
+            return self._nearest(rgb)
+        shift = 8 - self.lut_bits
+        q = (rgb >> shift).astype(np.int32)
+        return self._lut[(q[:, 0] << (2 * self.lut_bits)) | (q[:, 1] << self.lut_bits) | q[:, 2]]
+
+    def name_colors(self, rgb):
+        """Names an (n, 3) array of RGB colors in one call"""
+        return self.names[self.nearest_indices(rgb)].tolist()
+
+    def name_hex_colors(self, hex_colors):
+        if not hex_colors:
+            return []
+        return self.name_colors(hex_to_rgb_array(hex_colors))
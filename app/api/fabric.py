@@ -1,7 +1,21 @@
-import tensorflow as tf
-from tensorflow.keras.preprocessing import image
+import os
+import threading
 import numpy as np
-model = tf.keras.models.load_model('fabric24_model.keras')
+from PIL import Image
+from dotenv import load_dotenv
+from app.utils.batching import MicroBatcher
+
+load_dotenv()
+FABRIC_MODEL_URI = os.getenv('FABRIC_MODEL_URI', 'fabric24_model.keras')
+# keras runs the saved model, tflite converts it once for faster CPU inference
+FABRIC_BACKEND = os.getenv('FABRIC_BACKEND', 'keras')
+# none, dynamic (int8 weights) or float16, only used by the tflite backend
+FABRIC_QUANTIZE = os.getenv('FABRIC_QUANTIZE', 'dynamic')
+FABRIC_THREADS = int(os.getenv('FABRIC_THREADS', os.cpu_count() or 1))
+FABRIC_BATCH_SIZE = int(os.getenv('FABRIC_BATCH_SIZE', 16))
+FABRIC_BATCH_WAIT_MS = float(os.getenv('FABRIC_BATCH_WAIT_MS', 10))
+TARGET_SIZE = (150, 150)
+
 class_indices = {
     0: 'Denim',
     1: 'Silk',
@@ -37,29 +51,107 @@ fabric_to_season = {
     'Chiffon': ['Spring', 'Summer']
 }
 
-def preprocess_image(img_path, target_size=(150, 150)):
-    img = image.load_img(img_path, target_size=target_size)
-    img_array = image.img_to_array(img)
-    img_array = np.expand_dims(img_array, axis=0)
-    img_array = img_array / 255.0
-    return img_array
-
-def predict_image_class(img_path, model):
-    img_array = preprocess_image(img_path)
-    predictions = model.predict(img_array)
-    predicted_class = np.argmax(predictions[0])
-    return predicted_class
+def preprocess_image(img, target_size=TARGET_SIZE):
+    """Accepts a file path, a PIL image or an RGB/RGBA array, returns a (1, h, w, 3) float array"""
+    if isinstance(img, str):
+        img = Image.open(img)
+    elif isinstance(img, np.ndarray):
+        img = Image.fromarray(img)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        # Cutouts are classified on white, like the product photos the model saw
+        img = img.convert('RGBA')
+        background = Image.new('RGBA', img.size, (255, 255, 255, 255))
+        img = Image.alpha_composite(background, img)
+    # Nearest matches keras load_img, which the model was trained with
+    img = img.convert('RGB').resize(target_size, Image.NEAREST)
+    img_array = np.asarray(img, dtype=np.float32) / 255.0
+    return np.expand_dims(img_array, axis=0)
 
 def get_fabric_name(class_index):
     return class_indices.get(class_index, 'Unknown')
 
 def get_suitable_seasons(fabric_name):
     return fabric_to_season.get(fabric_name, 'Unknown')
-img_path = 'C:\\Users\\Dream4Net\\Desktop\\qw\\jeans15.jpg'  
-predicted_class = predict_image_class(img_path, model)
-fabric_name = get_fabric_name(predicted_class)
-suitable_seasons = get_suitable_seasons(fabric_name)
-
-print(f'Predicted class index: {predicted_class}')
-print(f'Predicted fabric type: {fabric_name}')
-print(f'Suitable seasons for {fabric_name}: {", ".join(suitable_seasons)}')
+
+class KerasBackend():
+    def __init__(self, model_path):
+        import tensorflow as tf
+        self.model = tf.keras.models.load_model(model_path)
+
+    def predict(self, batch):
+        return self.model.predict_on_batch(batch)
+
+class TFLiteBackend():
+    """Converts the Keras model to TFLite once and runs it with the CPU interpreter"""
+
+    def __init__(self, model_path, quantize=FABRIC_QUANTIZE, num_threads=FABRIC_THREADS):
+        import tensorflow as tf
+        tflite_path = f'{os.path.splitext(model_path)[0]}.{quantize}.tflite'
+        if not os.path.exists(tflite_path) or os.path.getmtime(tflite_path) < os.path.getmtime(model_path):
+            converter = tf.lite.TFLiteConverter.from_keras_model(tf.keras.models.load_model(model_path))
+            if quantize in ('dynamic', 'float16'):
+                converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if quantize == 'float16':
+                converter.target_spec.supported_types = [tf.float16]
+            with open(tflite_path, 'wb') as f:
+                f.write(converter.convert())
+        self.interpreter = tf.lite.Interpreter(model_path=tflite_path, num_threads=num_threads)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = None
+        # The interpreter is not thread-safe
+        self._lock = threading.Lock()
+
+    def predict(self, batch):
+        with self._lock:
+            if batch.shape[0] != self.batch_size:
+                self.interpreter.resize_tensor_input(self.input['index'], batch.shape)
+                self.interpreter.allocate_tensors()
+                self.batch_size = batch.shape[0]
+            self.interpreter.set_tensor(self.input['index'], batch.astype(self.input['dtype']))
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output['index']).copy()
+
+BACKENDS = {
+    'keras': KerasBackend,
+    'tflite': TFLiteBackend,
+}
+
+class FabricClassifier():
+    """Fabric and season prediction, model loaded on first use and batched across requests"""
+
+    def __init__(self, model_path=FABRIC_MODEL_URI, backend=FABRIC_BACKEND,
+                 batch_size=FABRIC_BATCH_SIZE, batch_wait_ms=FABRIC_BATCH_WAIT_MS):
+        self.model_path = model_path
+        self.backend_name = backend
+        self._backend = None
+        self._lock = threading.Lock()
+        self.batcher = MicroBatcher(self.predict_batch, max_batch_size=batch_size,
+                                    max_wait_ms=batch_wait_ms, name='fabric-batcher')
+
+    @property
+    def backend(self):
+        with self._lock:
+            if self._backend is None:
+                self._backend = BACKENDS[self.backend_name](self.model_path)
+            return self._backend
+
+    def predict_batch(self, images):
+        batch = np.concatenate([preprocess_image(img) for img in images], axis=0)
+        predictions = self.backend.predict(batch)
+        results = []
+        for class_index in np.argmax(predictions, axis=1):
+            fabric_name = get_fabric_name(int(class_index))
+            results.append({"fabric": fabric_name, "seasons": get_suitable_seasons(fabric_name)})
+        return results
+
+    def predict(self, image):
+        return self.batcher(image)
+
+def predict_image_class(img, model):
+    img_array = preprocess_image(img)
+    predictions = model.predict(img_array)
+    predicted_class = np.argmax(predictions[0])
+    return predicted_class
+
+fabric_classifier = FabricClassifier()
@@ -1,81 +1,155 @@
 import random
-import json
-from colorsys import rgb_to_hls
+import numpy as np
+
+REQUIRED_CATEGORIES = ["Tops", "Bottoms", "Shoes", "Bags", "Accessories"]
+
+# Hue distance (degrees) bands and how well two colors in them go together
+ANALOGOUS_HUE = 30
+TRIADIC_HUE = (105, 135)
+COMPLEMENTARY_HUE = (150, 210)
+
 
 def hex_to_rgb(hex_color):
     hex_color = hex_color.lstrip('#')
     return tuple(int(hex_color[i:i+2], 16) / 255.0 for i in (0, 2, 4))
 
-def rgb_to_hls_tuple(rgb):
-    return rgb_to_hls(rgb[0], rgb[1], rgb[2])
 
-def is_light_color(hex_code, brightness_threshold=200):
-    r, g, b = hex_to_rgb(hex_code)
-    brightness = (r + g + b) / 3
-    return brightness > brightness_threshold
+def rgb_to_hls_array(rgb):
+    """Vectorized colorsys.rgb_to_hls over an (n, 3) array of 0-1 floats"""
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    maxc = rgb.max(1)
+    minc = rgb.min(1)
+    delta = maxc - minc
+    l = (maxc + minc) / 2.0
+    gray = delta == 0
+    safe_delta = np.where(gray, 1.0, delta)
+    s = np.where(l <= 0.5, delta / np.where(gray, 1.0, maxc + minc), delta / np.where(gray, 1.0, 2.0 - maxc - minc))
+    rc = (maxc - r) / safe_delta
+    gc = (maxc - g) / safe_delta
+    bc = (maxc - b) / safe_delta
+    h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = (h / 6.0) % 1.0
+    h[gray] = 0.0
+    s[gray] = 0.0
+    return np.stack([h, l, s], axis=1)
+
 
 def is_soft_color(hex_code):
-    rgb = hex_to_rgb(hex_code)
-    h, l, s = rgb_to_hls_tuple(rgb)
+    h, l, s = rgb_to_hls_array(np.array([hex_to_rgb(hex_code)]))[0]
     return l > 0.7 and s < 0.3
 
-def get_soft_color_combination(colors):
-    soft_colors_list = [color for color in colors if is_soft_color(color)]
-    if len(soft_colors_list) < 2:
-        return soft_colors_list
-    return random.sample(soft_colors_list, 2)
-
-def select_color_for_category(category, colors_list, ids_list, names_list, categories_list, soft_colors=False):
-    indices = [i for i, cat in enumerate(categories_list) if cat == category]
-    if indices:
-        category_colors = [colors_list[i] for i in indices]
-        if soft_colors:
-            soft_combination = get_soft_color_combination(category_colors)
-            if soft_combination:
-                color = random.choice(soft_combination)
-            else:
-                color = random.choice(category_colors)
-        else:
-            color = random.choice(category_colors)
-        index = colors_list.index(color)
-        return { "name": names_list[index], "id": ids_list[index]}
-    return None
+
+class CategoryIndex():
+    """Items of one category with their colors flattened into NumPy arrays"""
+
+    def __init__(self, items):
+        # items: [(id, subcategory, [hex colors])]
+        self.ids = [item_id for item_id, _, _ in items]
+        self.names = [name for _, name, _ in items]
+        self.positions = {}
+        for i, item_id in enumerate(self.ids):
+            self.positions.setdefault(item_id, []).append(i)
+        colors = [(i, color) for i, (_, _, item_colors) in enumerate(items) for color in item_colors]
+        self.color_item = np.array([i for i, _ in colors], dtype=np.int64)
+        rgb = np.array([hex_to_rgb(color) for _, color in colors], dtype=np.float64).reshape(-1, 3)
+        self.hls = rgb_to_hls_array(rgb)
+        self.colors_per_item = np.bincount(self.color_item, minlength=len(items))
+        soft_colors = (self.hls[:, 1] > 0.7) & (self.hls[:, 2] < 0.3)
+        self.soft = np.bincount(self.color_item, weights=soft_colors, minlength=len(items)) > 0
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def pair_scores(hls_a, hls_b):
+    """Harmony score in [0, 1] for every pair of colors in hls_a x hls_b"""
+    if len(hls_b) == 0:
+        return np.ones((len(hls_a), 0))
+    hue_distance = np.abs(hls_a[:, None, 0] - hls_b[None, :, 0])
+    hue_distance = np.minimum(hue_distance, 1.0 - hue_distance) * 360.0
+    scores = np.full(hue_distance.shape, 0.3)
+    scores[(hue_distance >= TRIADIC_HUE[0]) & (hue_distance <= TRIADIC_HUE[1])] = 0.7
+    scores[(hue_distance >= COMPLEMENTARY_HUE[0]) & (hue_distance <= COMPLEMENTARY_HUE[1])] = 0.9
+    scores[hue_distance <= ANALOGOUS_HUE] = 1.0
+    # Blacks, whites and greys go with everything
+    neutral_a = (hls_a[:, 2] < 0.2) | (hls_a[:, 1] < 0.15) | (hls_a[:, 1] > 0.9)
+    neutral_b = (hls_b[:, 2] < 0.2) | (hls_b[:, 1] < 0.15) | (hls_b[:, 1] > 0.9)
+    scores[neutral_a[:, None] | neutral_b[None, :]] = 1.0
+    return scores
+
+
+class OutfitEngine():
+    """Indexes a wardrobe once and generates color-compatible outfits from it"""
+
+    def __init__(self, json_data, categories=REQUIRED_CATEGORIES):
+        self.categories = categories
+        grouped = {}
+        for category, subcategories in json_data.items():
+            for subcategory, items in subcategories.items():
+                for item in items:
+                    for id_, colors in item.items():
+                        grouped.setdefault(category, []).append((id_, subcategory, list(colors)))
+        self.index = {category: CategoryIndex(items) for category, items in grouped.items() if items}
+
+    def item_scores(self, category_index, chosen_hls):
+        """Mean harmony of each item's colors against the colors already in the outfit"""
+        if len(chosen_hls) == 0 or len(category_index.color_item) == 0:
+            return np.ones(len(category_index))
+        color_scores = pair_scores(category_index.hls, chosen_hls).mean(1)
+        totals = np.bincount(category_index.color_item, weights=color_scores, minlength=len(category_index))
+        return np.where(category_index.colors_per_item > 0,
+                        totals / np.maximum(category_index.colors_per_item, 1), 0.5)
+
+    def _choose(self, category_index, chosen_hls, soft_colors, excluded_ids, rng):
+        scores = self.item_scores(category_index, chosen_hls)
+        if soft_colors and category_index.soft.any():
+            scores = np.where(category_index.soft, scores, 0.0)
+        for item_id in excluded_ids:
+            scores[category_index.positions.get(item_id, [])] = 0.0
+        if scores.sum() <= 0:
+            return None
+        # Favour the best matches while still varying between calls
+        weights = scores ** 4
+        return int(rng.choice(len(scores), p=weights / weights.sum()))
+
+    def _generate_one(self, soft_colors, used_ids, rng):
+        outfit = {}
+        selected_ids = set()
+        chosen_hls = np.empty((0, 3))
+        for category in self.categories:
+            category_index = self.index.get(category)
+            if category_index is None:
+                continue
+            # Prefer items no earlier outfit of this call has used yet
+            i = self._choose(category_index, chosen_hls, soft_colors, selected_ids | used_ids, rng)
+            if i is None:
+                i = self._choose(category_index, chosen_hls, soft_colors, selected_ids, rng)
+            if i is None:
+                continue
+            outfit[category] = {"name": category_index.names[i], "id": category_index.ids[i]}
+            selected_ids.add(category_index.ids[i])
+            chosen_hls = np.concatenate([chosen_hls, category_index.hls[category_index.color_item == i]])
+        return outfit
+
+    def generate(self, count=1, soft_colors=False, seed=None, max_attempts_per_outfit=5):
+        """Returns up to count distinct outfits"""
+        rng = np.random.default_rng(seed)
+        outfits = []
+        seen = set()
+        used_ids = set()
+        for _ in range(count * max_attempts_per_outfit):
+            if len(outfits) == count:
+                break
+            outfit = self._generate_one(soft_colors, used_ids, rng)
+            signature = tuple(sorted((category, str(item["id"])) for category, item in outfit.items()))
+            if not outfit or signature in seen:
+                continue
+            seen.add(signature)
+            used_ids.update(item["id"] for item in outfit.values())
+            outfits.append(outfit)
+        return outfits
+
 
 def generate_outfit(json_data, soft_colors=False):
-    colors_list, ids_list, names_list, categories_list = [], [], [], []
-    for category, subcategories in json_data.items():
-        for subcategory, items in subcategories.items():
-            for item in items:
-                for id_, colors in item.items():
-                    for color in colors:
-                        colors_list.append(color)
-                        ids_list.append(id_)
-                        names_list.append(subcategory)
-                        categories_list.append(category)
-
-    required_categories = ["Tops", "Bottoms", "Shoes", "Bags", "Accessories"]
-    outfit = {}
-    
-    selected_ids = set()  
-    
-    for category in required_categories:
-        color_info = select_color_for_category(category, colors_list, ids_list, names_list, categories_list, soft_colors)
-        if color_info and color_info['id'] not in selected_ids:
-            outfit[category] = color_info
-            selected_ids.add(color_info['id'])
-
-    return outfit
-
-api_url = " " 
-response = requests.get(api_url)
-json_data = response.json()
-light_outfit = generate_outfit(json_data, soft_colors=False)
-soft_outfit = generate_outfit(json_data, soft_colors=True)
-
-output_data = {
-    "OUTFIT_1 ": light_outfit,
-    "OUTFIT_2": soft_outfit
-}
-
-with open('outfits.json', 'w') as outfile:
-    json.dump(output_data, outfile, indent=4)
+    outfits = OutfitEngine(json_data).generate(1, soft_colors=soft_colors, seed=random.randrange(2 ** 32))
+    return outfits[0] if outfits else {}
@@ -0,0 +1,68 @@
+import os
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+PALETTE_COLOR_COUNT = int(os.getenv('PALETTE_COLOR_COUNT', 5))
+PALETTE_SAMPLE_SIZE = int(os.getenv('PALETTE_SAMPLE_SIZE', 20000))
+PALETTE_KMEANS_ITERATIONS = int(os.getenv('PALETTE_KMEANS_ITERATIONS', 5))
+PALETTE_ALPHA_THRESHOLD = int(os.getenv('PALETTE_ALPHA_THRESHOLD', 128))
+# Bits per channel for the histogram that seeds the clusters
+HISTOGRAM_BITS = 4
+
+
+def foreground_pixels(image, sample_size=PALETTE_SAMPLE_SIZE, alpha_threshold=PALETTE_ALPHA_THRESHOLD):
+    """Returns up to sample_size RGB pixels, only opaque ones when the image has alpha"""
+    if getattr(image, 'mode', 'RGB') not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    pixels = np.asarray(image)
+    channels = pixels.shape[-1]
+    pixels = pixels.reshape(-1, channels)
+    if channels == 4:
+        opaque = np.flatnonzero(pixels[:, 3] >= alpha_threshold)
+        # A cutout with no foreground left falls back to the whole image
+        indices = opaque if len(opaque) else np.arange(len(pixels))
+    else:
+        indices = np.arange(len(pixels))
+    if sample_size and len(indices) > sample_size:
+        # A fixed stride keeps the palette of the same image stable between calls
+        indices = indices[::int(np.ceil(len(indices) / sample_size))]
+    return pixels[indices, :3].astype(np.float32)
+
+
+def _histogram_seeds(pixels, color_count):
+    shift = 8 - HISTOGRAM_BITS
+    q = pixels.astype(np.int32) >> shift
+    bins = (q[:, 0] << (2 * HISTOGRAM_BITS)) | (q[:, 1] << HISTOGRAM_BITS) | q[:, 2]
+    n_bins = 1 << (3 * HISTOGRAM_BITS)
+    counts = np.bincount(bins, minlength=n_bins)
+    top = np.argsort(counts)[::-1][:color_count]
+    top = top[counts[top] > 0]
+    sums = np.stack([np.bincount(bins, weights=pixels[:, c], minlength=n_bins) for c in range(3)], axis=1)
+    return sums[top] / counts[top, None]
+
+
+def extract_palette(image, color_count=PALETTE_COLOR_COUNT, sample_size=PALETTE_SAMPLE_SIZE,
+                    iterations=PALETTE_KMEANS_ITERATIONS):
+    """Returns [(r, g, b), ...] and their pixel shares, most common color first"""
+    pixels = foreground_pixels(image, sample_size)
+    if len(pixels) == 0:
+        return [], []
+    centers = _histogram_seeds(pixels, color_count)
+    pixels_sq = (pixels ** 2).sum(1)
+    for step in range(iterations + 1):
+        distances = pixels_sq[:, None] - 2.0 * pixels @ centers.T + (centers ** 2).sum(1)[None, :]
+        assignment = distances.argmin(1)
+        counts = np.bincount(assignment, minlength=len(centers))
+        if step == iterations:
+            break
+        sums = np.stack([np.bincount(assignment, weights=pixels[:, c], minlength=len(centers))
+                         for c in range(3)], axis=1)
+        # Empty clusters keep their previous center
+        filled = counts > 0
+        centers[filled] = sums[filled] / counts[filled, None]
+    order = np.argsort(counts)[::-1]
+    order = order[counts[order] > 0]
+    colors = [tuple(int(v) for v in np.clip(np.rint(centers[i]), 0, 255)) for i in order]
+    weights = (counts[order] / counts.sum()).round(4).tolist()
+    return colors, weights
@@ -0,0 +1,95 @@
+import os
+import asyncio
+from dotenv import load_dotenv
+from app.api.recognize_clothe_and_color import process_and_annotate_image, RESULT_VERSION
+from app.utils.cache import result_cache, content_key
+from app.utils.executor import pipeline_executor, QueueFullError
+from app.utils.inference_pool import inference_pool, SharedFrame
+from app.utils.storage import image_store
+from app.utils.metrics import run_collected, record_observations, profile_sampler, cache_lookups
+
+load_dotenv()
+QUEUE_FULL_WAIT = float(os.getenv('BATCH_QUEUE_FULL_WAIT', 0.2))
+
+if inference_pool.enabled and pipeline_executor.kind == 'process':
+    # The inference workers replace the process executor, decoding into shared memory needs threads
+    raise RuntimeError("INFERENCE_WORKERS needs PIPELINE_EXECUTOR=thread")
+if image_store.async_uploads and (inference_pool.enabled or pipeline_executor.kind == 'process'):
+    # Upload jobs would live in the worker processes, where GET /uploads/{job_id} can't see them
+    raise RuntimeError("STORAGE_ASYNC=1 needs uploads in the API process, "
+                       "it can't be combined with INFERENCE_WORKERS or PIPELINE_EXECUTOR=process")
+
+
+async def run_pipeline(image_bytes, bg_model=None, annotate=False, wait_when_full=False, path=''):
+    """Runs the recognition pipeline on the executor or the inference pool, returns (result, stage observations).
+    Raises QueueFullError when they are full, unless wait_when_full is set."""
+    profile = profile_sampler.should_profile()
+    if inference_pool.enabled:
+        outcome = await _run_in_inference_pool(image_bytes, bg_model, annotate, wait_when_full, profile)
+    else:
+        outcome = await _run_on_executor(image_bytes, bg_model, annotate, wait_when_full, profile)
+    result, observations, profile_text = outcome
+    record_observations(observations)
+    if profile_text:
+        profile_sampler.add(path, profile_text)
+    return result, observations
+
+
+async def _submit(wait_when_full, fn, *args, **kwargs):
+    while True:
+        try:
+            return pipeline_executor.submit(fn, *args, **kwargs)
+        except QueueFullError:
+            if not wait_when_full:
+                raise
+            await asyncio.sleep(QUEUE_FULL_WAIT)
+
+
+async def _run_on_executor(image_bytes, bg_model, annotate, wait_when_full, profile):
+    if pipeline_executor.kind == 'process' and not isinstance(image_bytes, bytes):
+        # An mmap can't be pickled to a worker process
+        image_bytes = bytes(image_bytes)
+    future = await _submit(wait_when_full, run_collected, process_and_annotate_image, image_bytes, bg_model,
+                           annotate, profile=profile)
+    return await asyncio.wrap_future(future)
+
+
+def _release_decoded(decoding):
+    if not decoding.cancelled() and decoding.exception() is None:
+        frame, _, _ = decoding.result()
+        frame.release()
+
+
+async def _run_in_inference_pool(image_bytes, bg_model, annotate, wait_when_full, profile):
+    # Checked before decoding so an overloaded pool does not cost a decode per rejected request
+    while inference_pool.full():
+        if not wait_when_full:
+            raise QueueFullError('Inference pool is full')
+        await asyncio.sleep(QUEUE_FULL_WAIT)
+    # Decoding stays in the API process, the workers only see the shared frame
+    decoding = await _submit(wait_when_full, run_collected, SharedFrame.decode, image_bytes)
+    try:
+        frame, decode_observations, _ = await asyncio.wrap_future(decoding)
+    except asyncio.CancelledError:
+        # A decode already running can't be stopped, its frame is released once it is made
+        decoding.add_done_callback(_release_decoded)
+        raise
+    # The pool owns the frame once submit is called, it releases it on failure too
+    future = inference_pool.submit(frame, content_key(image_bytes, bg_model), bg_model, annotate, profile)
+    result, observations, profile_text = await asyncio.wrap_future(future)
+    return result, decode_observations + observations, profile_text
+
+
+async def recognize_cached(image_bytes, bg_model=None, annotate=False, wait_when_full=True, path=''):
+    """Runs one image through the result cache and the pipeline, returns (result, observations, hit)"""
+    cache_key = content_key(image_bytes, bg_model, annotate and 'annotate', RESULT_VERSION)
+    cached = await result_cache.get_async(cache_key)
+    if cached is not None:
+        cache_lookups.inc('hit')
+        return cached, [], True
+    cache_lookups.inc('miss')
+    result, observations = await run_pipeline(image_bytes, bg_model, annotate, wait_when_full, path)
+    if "upload_job_ids" not in result:
+        # Uploads still running in the background may fail, so their URLs are not cached
+        await result_cache.set_async(cache_key, result)
+    return result, observations, False
@@ -1,81 +1,202 @@
 import requests
 from io import BytesIO
-from ultralytics import YOLO
-from rembg import remove
 from PIL import Image
 import cv2
 import numpy as np
-import pandas as pd
-from colorthief import ColorThief
-import cloudinary.uploader
-import uuid
-from config.cloudinaryConfig import cloudinary
 import os
 from dotenv import load_dotenv
+from app.utils.batching import MicroBatcher
+from app.models.background_removal import remove_background, session_pool
+from app.models.registry import model_registry
+from app.models.detector import load_detector, DETECTOR_BACKEND
+from app.utils.ingest import decode_image
+from app.utils.cache import content_key
+from app.utils.storage import image_store
+from app.api.color_naming import ColorNamer
+from app.api.palette import extract_palette
+from app.utils.metrics import stage
 
 load_dotenv()
 YOLO_model = os.getenv('MODEL_URI')
 Color_cvs = os.getenv('COLOR_URI')
-# Load the YOLO model once
-model = YOLO(YOLO_model)
-
-# Read the colors CSV file once
-csv_path = Color_cvs
-index = ['color', 'color_name', 'hex', 'R', 'G', 'B']
-color_df = pd.read_csv(csv_path, names=index, header=None)
-
-def upload_image_to_cloudinary(image):
-    unique_filename = str(uuid.uuid4())
-    result = cloudinary.uploader.upload(image, public_id=unique_filename, overwrite=True, resource_type="image")
-    return result['secure_url']
-
-def process_image(input_image):
-    # Remove the background
-    image_no_bg = remove(input_image)
-
-    # Convert the image to a format compatible with OpenCV
-    image_no_bg_cv = np.array(image_no_bg)
-    image_no_bg_cv = cv2.cvtColor(image_no_bg_cv, cv2.COLOR_RGB2BGR)
-
-    # Perform object detection
-    results = model(image_no_bg)
-    resultss = results[0].boxes.data.cpu().numpy()
-
-    label = None
-    for result in resultss:
-        xmin, ymin, xmax, ymax, score, class_id = result
-        label = model.names[int(class_id)]
-        confidence = score
-        cv2.rectangle(image_no_bg_cv, (int(xmin), int(ymin)), (int(xmax), int(ymax)), (255, 0, 0), 2)
-        text = f'{label} {confidence:.2f}'
-        (text_width, text_height), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 1.5, 3)
-        cv2.rectangle(image_no_bg_cv, (int(xmin), int(ymin) - text_height - 10), (int(xmin) + text_width, int(ymin)), (255, 0, 0), -1)
-        cv2.putText(image_no_bg_cv, text, (int(xmin), int(ymin) - 5), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (255, 255, 255), 3)
-
-    return image_no_bg, label
+DETECT_BATCH_SIZE = int(os.getenv('DETECT_BATCH_SIZE', 8))
+DETECT_BATCH_WAIT_MS = float(os.getenv('DETECT_BATCH_WAIT_MS', 10))
+FABRIC_ENABLED = os.getenv('FABRIC_ENABLED', '0') == '1'
+DETECT_MIN_CONFIDENCE = float(os.getenv('DETECT_MIN_CONFIDENCE', 0.25))
+# Each item costs a rembg pass, an encode and an upload, so a cluttered photo keeps only the most confident
+DETECT_MAX_ITEMS = int(os.getenv('DETECT_MAX_ITEMS', 8))
+# Boxes of different classes overlapping this much are one garment detected twice, the more confident wins
+DETECT_MERGE_IOU = float(os.getenv('DETECT_MERGE_IOU', 0.7))
+# Extra margin around each box so rembg sees the garment's edges
+CROP_PADDING = float(os.getenv('CROP_PADDING', 0.05))
+CROP_MAX_SIDE = int(os.getenv('CROP_MAX_SIDE', 512))
+# Bumped whenever the response shape changes, so cached results of the old shape are not served
+RESULT_VERSION = 'items-v2'
+# Models are loaded once through the registry, on first use or at startup
+model_registry.register('detector', lambda: load_detector(YOLO_model),
+                        warmup=lambda model, image: model(image, verbose=False),
+                        fork_safe=DETECTOR_BACKEND == 'torch')
+model_registry.register('background_removal', session_pool.preload,
+                        warmup=lambda pool, image: remove_background(image), fork_safe=False)
+model_registry.register('color_namer', lambda: ColorNamer(Color_cvs))
+
+def detect_batch(images):
+    # One forward pass for every image collected from concurrent requests
+    return model_registry.get('detector')(images, verbose=False)
+
+detector = MicroBatcher(detect_batch, max_batch_size=DETECT_BATCH_SIZE,
+                        max_wait_ms=DETECT_BATCH_WAIT_MS, name='yolo-batcher')
+
+if FABRIC_ENABLED:
+    # Only pull in TensorFlow when fabric tagging is switched on
+    from app.api.fabric import fabric_classifier
+    model_registry.register('fabric', lambda: fabric_classifier.backend,
+                            warmup=lambda backend, image: fabric_classifier.predict_batch([image]), fork_safe=False)
+
+def upload_image(image, public_id=None):
+    # A content-derived public_id makes re-uploads of the same photo overwrite one asset
+    return image_store.upload(image, public_id=public_id)
+
+def detect_items(input_image):
+    # Perform object detection, including the wait for a batch to fill
+    with stage('yolo'):
+        results = detector(input_image)
+    names = model_registry.get('detector').names
+    items = []
+    for xmin, ymin, xmax, ymax, score, class_id in results.boxes.data.cpu().numpy():
+        if score < DETECT_MIN_CONFIDENCE:
+            continue
+        items.append({
+            "label": names[int(class_id)],
+            "confidence": round(float(score), 4),
+            "box": [int(xmin), int(ymin), int(xmax), int(ymax)],
+        })
+    kept = []
+    for item in sorted(items, key=lambda item: item["confidence"], reverse=True):
+        # The detector's NMS is per class, so one garment can come back under two labels
+        if any(box_iou(item["box"], other["box"]) >= DETECT_MERGE_IOU for other in kept):
+            continue
+        kept.append(item)
+        if len(kept) == DETECT_MAX_ITEMS:
+            break
+    return kept
+
+def box_iou(a, b):
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    overlap = width * height
+    return overlap / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - overlap)
+
+def crop_item(input_image, box):
+    width, height = input_image.size
+    xmin, ymin, xmax, ymax = box
+    pad_x = int((xmax - xmin) * CROP_PADDING)
+    pad_y = int((ymax - ymin) * CROP_PADDING)
+    crop = input_image.crop((max(0, xmin - pad_x), max(0, ymin - pad_y),
+                             min(width, xmax + pad_x), min(height, ymax + pad_y)))
+    if max(crop.size) > CROP_MAX_SIDE:
+        crop.thumbnail((CROP_MAX_SIDE, CROP_MAX_SIDE), Image.BILINEAR)
+    return crop
+
+def find_items(input_image):
+    items = detect_items(input_image)
+    if not items:
+        # Nothing detected, treat the whole photo as one unlabelled item
+        width, height = input_image.size
+        items = [{"label": None, "confidence": None, "box": [0, 0, width, height]}]
+    return items
+
+def cut_out_items(input_image, items, bg_model=None):
+    cutouts = []
+    for item in items:
+        with stage('crop'):
+            crop = crop_item(input_image, item["box"])
+        # Remove the background with a pooled session
+        with stage('rembg'):
+            cutouts.append(remove_background(crop, model=bg_model))
+    return cutouts
+
+def process_image(input_image, bg_model=None):
+    """Detects every item, then removes the background of each item's crop only"""
+    items = find_items(input_image)
+    return items, cut_out_items(input_image, items, bg_model)
+
+def annotate_image(input_image, items):
+    """Draws the detected boxes and labels, only done when a caller asks for it"""
+    annotated = cv2.cvtColor(np.array(input_image), cv2.COLOR_RGB2BGR)
+    for item in items:
+        if item["label"] is None:
+            continue
+        xmin, ymin, xmax, ymax = item["box"]
+        cv2.rectangle(annotated, (xmin, ymin), (xmax, ymax), (255, 0, 0), 2)
+        text = f'{item["label"]} {item["confidence"]:.2f}'
+        (text_width, text_height), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.8, 2)
+        cv2.rectangle(annotated, (xmin, ymin - text_height - 10), (xmin + text_width, ymin), (255, 0, 0), -1)
+        cv2.putText(annotated, text, (xmin, ymin - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+    return Image.fromarray(cv2.cvtColor(annotated, cv2.COLOR_BGR2RGB))
 
 def extract_color_palette(image):
-    # Extract the color palette from the input image
-    ct = ColorThief(image)
-    palette = ct.get_palette(color_count=5)
+    # Extract the color palette from the garment pixels of the cutout
+    palette, weights = extract_palette(image)
     hex_colors = ['#%02x%02x%02x' % color for color in palette]
-    return hex_colors
-
-def process_and_annotate_image(input_image_bytes):
-    input_image = Image.open(BytesIO(input_image_bytes))
-    image_no_bg, label = process_image(input_image)
-    color_palette = extract_color_palette(BytesIO(input_image_bytes))
-    
-    # Convert the image to a format suitable for upload
-    buffer = BytesIO()
-    image_no_bg.save(buffer, format="PNG")
-    image_data = buffer.getvalue()
-    
-    # Upload the image to Cloudinary and get the URL
-    image_url = upload_image_to_cloudinary(image_data)
-    
-    return {
-        "image_without_background_url": image_url,
-        "label": label,
-        "color_palette": color_palette
+    return hex_colors, weights
+
+def encode_png(image):
+    with stage('encode'):
+        buffer = BytesIO()
+        image.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+def process_and_annotate_image(input_image_bytes, bg_model=None, annotate=False):
+    # Decode once, detection and every crop work from the same image
+    with stage('decode'):
+        input_image = decode_image(input_image_bytes)
+    return analyse_image(input_image, content_key(input_image_bytes, bg_model), bg_model, annotate)
+
+def analyse_image(input_image, public_id, bg_model=None, annotate=False):
+    """Everything after decoding, inference workers run this on a frame they share with the API"""
+    items, cutouts = process_image(input_image, bg_model)
+    uploads = []
+
+    for i, (item, cutout) in enumerate(zip(items, cutouts)):
+        with stage('palette'):
+            color_palette, color_weights = extract_color_palette(cutout)
+            item["color_palette"] = color_palette
+            item["color_weights"] = color_weights
+            item["color_names"] = model_registry.get('color_namer').name_hex_colors(color_palette)
+        if FABRIC_ENABLED:
+            with stage('fabric'):
+                item.update(fabric_classifier.predict(cutout))
+        # Upload the cutout to the configured storage and get the URL
+        image_data = encode_png(cutout)
+        with stage('upload'):
+            upload = upload_image(image_data, public_id=public_id if i == 0 else f'{public_id}-{i}')
+        item["image_without_background_url"] = upload["url"]
+        uploads.append(upload)
+
+    # The most confident item keeps filling the original top-level fields
+    primary = items[0]
+    result = {
+        "image_without_background_url": primary["image_without_background_url"],
+        "label": primary["label"],
+        "color_palette": primary["color_palette"],
+        "color_weights": primary["color_weights"],
+        "color_names": primary["color_names"],
+        "items": items,
     }
+    if FABRIC_ENABLED:
+        result["fabric"] = primary["fabric"]
+        result["seasons"] = primary["seasons"]
+    if annotate:
+        image_data = encode_png(annotate_image(input_image, items))
+        with stage('upload'):
+            upload = upload_image(image_data, public_id=f'{public_id}-annotated')
+        result["annotated_image_url"] = upload["url"]
+        uploads.append(upload)
+    job_ids = [upload["job_id"] for upload in uploads if "job_id" in upload]
+    if job_ids:
+        result["upload_job_id"] = job_ids[0]
+        result["upload_job_ids"] = job_ids
+    return result
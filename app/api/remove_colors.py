@@ -1,4 +1,3 @@
-import pandas as pd
 import matplotlib.pyplot as plt
 from colorthief import ColorThief
 import easygui
@@ -6,29 +5,33 @@ import cv2
 from rembg import remove
 from PIL import Image
 import os
+from color_naming import ColorNamer
 #Simulation of remove background,analyze color and save them
 csv_path = '.\colors.csv'
-index = ['color', 'color_name', 'hex', 'R', 'G', 'B']
 
-color_df = pd.read_csv(csv_path, names=index, header=None)
+color_namer = ColorNamer(csv_path)
 
 def capture_image():
+    # Kept in memory, no round trip through a file on disk.
+    # For a live feed use the stream mode: python -m app.api.stream 0 --realtime
     cap = cv2.VideoCapture(0)
     ret, frame = cap.read()
-    cv2.imwrite("captured_image.png", frame)
     cap.release()
+    if not ret:
+        return None
+    return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
 
 def select_image():
     image_path = easygui.fileopenbox(title='Select image file')
     return image_path
 
-def get_image_path():
+def get_image():
     choice = easygui.buttonbox("Choose image source", choices=["Camera", "Library"])
     if choice == "Camera":
-        capture_image()
-        return "captured_image.png"
+        return capture_image()
     elif choice == "Library":
-        return select_image()
+        image_path = select_image()
+        return Image.open(image_path) if image_path else None
     else:
         return None
 
@@ -38,13 +41,12 @@ def create_color_images_folder():
         os.makedirs(output_folder)
     return output_folder
 
-image_path = get_image_path()
+input_image = get_image()
 
-if not image_path:
+if input_image is None:
     print("No image selected or captured. Exiting...")
     exit()
 
-input_image = Image.open(image_path)
 output_image = remove(input_image)
 
 outputpath = easygui.filesavebox(title='Save file to ', default='output.png', filetypes=['*.png', '*.jpg', '*.jpeg'])
@@ -60,10 +62,10 @@ ct = ColorThief(outputpath)
 palette = ct.get_palette(color_count=3)
 
 output_folder = create_color_images_folder()
+# Name the whole palette in one call
+color_names = color_namer.name_colors(palette)
 
-for color in palette:
-    closest_color = color_df.iloc[(color_df[['R', 'G', 'B']] - color).pow(2).sum(1).idxmin()]
-    color_name = closest_color['color_name']
+for color, color_name in zip(palette, color_names):
     color_image = Image.new("RGB", (100, 100), color)
     color_image_path = os.path.join(output_folder, f"{color_name}.png")
     color_image.save(color_image_path)
@@ -71,10 +73,7 @@ for color in palette:
 # Display color images
 fig, axs = plt.subplots(1, len(palette) + 1, figsize=(15, 3))
 
-for i, color in enumerate(palette):
-    closest_color = color_df.iloc[(color_df[['R', 'G', 'B']] - color).pow(2).sum(1).idxmin()]
-    color_name = closest_color['color_name']
-    
+for i, (color, color_name) in enumerate(zip(palette, color_names)):
     axs[i].imshow([[color]])
     axs[i].set_title(f"{color_name}\nRGB: {color}")
     axs[i].axis('off')
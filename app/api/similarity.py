@@ -0,0 +1,160 @@
+import os
+import json
+from functools import lru_cache
+import numpy as np
+from dotenv import load_dotenv
+from app.api.color_naming import srgb_to_lab, hex_to_rgb_array
+from app.models.similarity_index import SimilarityIndex, file_lock
+
+load_dotenv()
+SIMILARITY_INDEX_DIR = os.getenv('SIMILARITY_INDEX_DIR', os.path.join('data', 'similarity_index'))
+# Width in CIELAB units of the kernel that spreads each palette color over nearby anchors
+SIMILARITY_PALETTE_SIGMA = float(os.getenv('SIMILARITY_PALETTE_SIGMA', 20.0))
+# Share of the score that comes from a matching class and from the embedding, the rest is palette
+SIMILARITY_CLASS_WEIGHT = float(os.getenv('SIMILARITY_CLASS_WEIGHT', 0.3))
+SIMILARITY_EMBEDDING_WEIGHT = float(os.getenv('SIMILARITY_EMBEDDING_WEIGHT', 0.3))
+# 0 leaves embeddings out of the vectors
+SIMILARITY_EMBEDDING_DIM = int(os.getenv('SIMILARITY_EMBEDDING_DIM', 0))
+SIMILARITY_MAX_CLASSES = int(os.getenv('SIMILARITY_MAX_CLASSES', 32))
+
+# 4 levels per sRGB channel, compared in CIELAB so distances follow perceived difference
+ANCHOR_LEVELS = (0, 85, 170, 255)
+ANCHORS_LAB = srgb_to_lab(np.stack(np.meshgrid(ANCHOR_LEVELS, ANCHOR_LEVELS, ANCHOR_LEVELS, indexing='ij'),
+                                   axis=-1).reshape(-1, 3))
+
+
+def _unit(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def palette_vector(hex_colors, weights=None, sigma=SIMILARITY_PALETTE_SIGMA):
+    """Soft histogram of a weighted palette over fixed CIELAB anchors, unit length.
+    Unlike the raw palette it has a fixed size and does not depend on color order."""
+    if not hex_colors:
+        return np.zeros(len(ANCHORS_LAB), dtype=np.float32)
+    lab = srgb_to_lab(hex_to_rgb_array(hex_colors))
+    distances = ((lab[:, None, :] - ANCHORS_LAB[None, :, :]) ** 2).sum(axis=2)
+    # Relative to the nearest anchor so the exponent can't underflow for every anchor
+    kernel = np.exp(-(distances - distances.min(axis=1, keepdims=True)) / (2.0 * sigma ** 2))
+    kernel /= kernel.sum(axis=1, keepdims=True)
+    weights = np.ones(len(hex_colors)) if weights is None else np.asarray(weights, dtype=np.float32)
+    if len(weights) != len(hex_colors):
+        raise ValueError("color_weights must have one weight per palette color")
+    return _unit((weights @ kernel).astype(np.float32))
+
+
+class WardrobeIndex():
+    """Feature vectors of wardrobe items for similar-item lookups and de-duplication.
+    Each vector is a weighted palette part, a one-hot class part and optionally an embedding,
+    so a dot product is the weighted sum of palette cosine, class match and embedding cosine."""
+
+    def __init__(self, directory, sigma=SIMILARITY_PALETTE_SIGMA, class_weight=SIMILARITY_CLASS_WEIGHT,
+                 embedding_dim=SIMILARITY_EMBEDDING_DIM, embedding_weight=SIMILARITY_EMBEDDING_WEIGHT,
+                 max_classes=SIMILARITY_MAX_CLASSES):
+        os.makedirs(directory, exist_ok=True)
+        self.meta_path = os.path.join(directory, 'meta.json')
+        # Shared with the SimilarityIndex in this directory, other workers may write meta.json too
+        self.lock_path = os.path.join(directory, 'lock')
+        self._meta_stat = None
+        with file_lock(self.lock_path):
+            if not self._reload_meta():
+                self.meta = {
+                    "sigma": sigma,
+                    "class_weight": class_weight,
+                    "embedding_dim": embedding_dim,
+                    "embedding_weight": embedding_weight if embedding_dim else 0.0,
+                    "max_classes": max_classes,
+                    "labels": {},
+                }
+                self._save_meta()
+        self.embedding_dim = self.meta["embedding_dim"]
+        dim = len(ANCHORS_LAB) + self.meta["max_classes"] + self.embedding_dim
+        self.index = SimilarityIndex(directory, dim)
+
+    def _reload_meta(self):
+        """Reads meta.json when it changed on disk, False when there is none yet"""
+        try:
+            stat = os.stat(self.meta_path)
+        except FileNotFoundError:
+            return False
+        if (stat.st_mtime_ns, stat.st_size) != self._meta_stat:
+            # Vectors already on disk were built with these settings, they win over the environment
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+            self._meta_stat = (stat.st_mtime_ns, stat.st_size)
+        return True
+
+    def _save_meta(self):
+        tmp_path = f'{self.meta_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_path)
+        stat = os.stat(self.meta_path)
+        self._meta_stat = (stat.st_mtime_ns, stat.st_size)
+
+    def class_slot(self, label, create=False):
+        """Slot of a label in the class part, None for no label or a label never indexed"""
+        if label is None:
+            return None
+        self._reload_meta()
+        if label not in self.meta["labels"] and create:
+            # Assigned under the directory lock from the latest meta.json, so workers agree on slots
+            with file_lock(self.lock_path):
+                self._reload_meta()
+                labels = self.meta["labels"]
+                if label not in labels:
+                    # Labels past max_classes share the last slot
+                    labels[label] = min(len(labels), self.meta["max_classes"] - 1)
+                    self._save_meta()
+        return self.meta["labels"].get(label)
+
+    def features(self, label, color_palette, color_weights=None, embedding=None, create=False):
+        palette_weight = 1.0 - self.meta["class_weight"] - self.meta["embedding_weight"]
+        classes = np.zeros(self.meta["max_classes"], dtype=np.float32)
+        slot = self.class_slot(label, create)
+        if slot is not None:
+            classes[slot] = 1.0
+        parts = [np.sqrt(palette_weight) * palette_vector(color_palette, color_weights, self.meta["sigma"]),
+                 np.sqrt(self.meta["class_weight"]) * classes]
+        if self.embedding_dim:
+            vector = np.zeros(self.embedding_dim, dtype=np.float32)
+            if embedding is not None:
+                vector = np.asarray(embedding, dtype=np.float32)
+                if vector.shape != (self.embedding_dim,):
+                    raise ValueError(f"embedding must have {self.embedding_dim} values")
+            parts.append(np.sqrt(self.meta["embedding_weight"]) * _unit(vector))
+        elif embedding is not None:
+            raise ValueError("This index was created without embeddings")
+        return np.concatenate(parts).astype(np.float32), -1 if slot is None else slot
+
+    def add_many(self, items):
+        """items are dicts shaped like a recognized item plus an item_id (and optionally an embedding)"""
+        ids, vectors, groups = [], [], []
+        for item in items:
+            vector, group = self.features(item.get("label"), item["color_palette"], item.get("color_weights"),
+                                          item.get("embedding"), create=True)
+            ids.append(item["item_id"])
+            vectors.append(vector)
+            groups.append(group)
+        self.index.add_many(ids, vectors, groups)
+        return len(ids)
+
+    def similar(self, label, color_palette, color_weights=None, embedding=None, k=10, same_label=False,
+                exclude_id=None, min_score=None):
+        vector, group = self.features(label, color_palette, color_weights, embedding)
+        if same_label and group < 0:
+            # Nothing was ever indexed under this label
+            return []
+        results = self.index.search(vector, k, group=group if same_label else None,
+                                    exclude=[exclude_id] if exclude_id else (), min_score=min_score)
+        return [{"item_id": item_id, "score": round(score, 4)} for item_id, score in results]
+
+    def __len__(self):
+        return len(self.index)
+
+
+@lru_cache(maxsize=1)
+def get_wardrobe_index():
+    """Opened on first use, so the index directory is only created when the feature is used"""
+    return WardrobeIndex(SIMILARITY_INDEX_DIR)
@@ -0,0 +1,357 @@
+"""Live recognition over a camera, video file or any iterable of frames.
+
+Frames flow through a pipeline of threads (decode, detect, segment, palette)
+joined by short queues, so each stage works on a different frame at the same time.
+When the source is live (a camera, or a file played back in real time) and the
+stages fall behind, frames are dropped at the decode stage and the newest frame
+wins. Frames that barely differ from the last analysed one reuse its result,
+and palettes are smoothed over time per item:
+
+    python -m app.api.stream closet.mp4 --realtime --output frames.ndjson
+"""
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import deque
+import numpy as np
+from PIL import Image
+from dotenv import load_dotenv
+from app.api.recognize_clothe_and_color import find_items, cut_out_items
+from app.api.palette import extract_palette
+from app.models.registry import model_registry
+from app.utils.metrics import stage
+
+load_dotenv()
+STREAM_MAX_SIDE = int(os.getenv('STREAM_MAX_SIDE', 640))
+# Frames waiting between two stages, small so results stay close to live
+STREAM_QUEUE_SIZE = int(os.getenv('STREAM_QUEUE_SIZE', 2))
+# Mean absolute difference (0-255) of a 32x32 grayscale thumbnail below which a frame reuses the last result
+STREAM_REUSE_THRESHOLD = float(os.getenv('STREAM_REUSE_THRESHOLD', 3.0))
+# Weight of the newest palette in the moving average, 1 turns smoothing off
+STREAM_SMOOTHING = float(os.getenv('STREAM_SMOOTHING', 0.3))
+# Analysed frames an item may be missing before its smoothed palette is forgotten
+STREAM_TRACK_MAX_AGE = int(os.getenv('STREAM_TRACK_MAX_AGE', 15))
+SIGNATURE_SIZE = (32, 32)
+FPS_WINDOW_SECONDS = 2.0
+
+_DONE = object()
+
+
+def _fit(image, max_side):
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.BILINEAR)
+    return image
+
+
+def video_frames(source, max_side=STREAM_MAX_SIDE):
+    """Yields (media time in seconds or None, RGB image) from a camera index, file path or URL"""
+    import cv2
+    live = isinstance(source, int) or str(source).isdigit()
+    capture = cv2.VideoCapture(int(source) if live else source)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video source {source!r}")
+    fps = 0 if live else capture.get(cv2.CAP_PROP_FPS)
+    index = 0
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                return
+            height, width = frame.shape[:2]
+            if max_side and max(width, height) > max_side:
+                # Shrinking before the color conversion keeps both cheap
+                scale = max_side / max(width, height)
+                frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+            image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            yield (index / fps if fps else None), image
+            index += 1
+    finally:
+        capture.release()
+
+
+def iter_frames(source, max_side=STREAM_MAX_SIDE):
+    """Accepts what video_frames does, or an iterable of PIL images or RGB arrays"""
+    if isinstance(source, (str, int)):
+        yield from video_frames(source, max_side)
+        return
+    for frame in source:
+        image = frame if isinstance(frame, Image.Image) else Image.fromarray(np.asarray(frame))
+        yield None, _fit(image.convert('RGB'), max_side)
+
+
+def frame_signature(image):
+    return np.asarray(image.convert('L').resize(SIGNATURE_SIZE, Image.BILINEAR), dtype=np.float32)
+
+
+class PaletteSmoother():
+    """Exponential moving average of each item's palette across frames.
+    Colors are matched to the previous palette by distance, since k-means does not keep their order."""
+
+    def __init__(self, alpha=STREAM_SMOOTHING, max_age=STREAM_TRACK_MAX_AGE):
+        self.alpha = alpha
+        self.max_age = max_age
+        # key -> (colors (k, 3) float, weights (k,), analysed frame it was last seen in)
+        self._tracks = {}
+        self._frame = 0
+
+    def update(self, key, colors, weights):
+        colors = np.asarray(colors, dtype=np.float32).reshape(-1, 3)
+        weights = np.asarray(weights, dtype=np.float32)
+        track = self._tracks.get(key)
+        if track is not None and self._frame - track[2] <= self.max_age and len(track[0]) == len(colors):
+            previous_colors, previous_weights, _ = track
+            order = self._match(previous_colors, colors)
+            colors = previous_colors + self.alpha * (colors[order] - previous_colors)
+            weights = previous_weights + self.alpha * (weights[order] - previous_weights)
+        self._tracks[key] = (colors, weights, self._frame)
+        return colors, weights
+
+    def next_frame(self):
+        self._frame += 1
+        stale = [key for key, track in self._tracks.items() if self._frame - track[2] > self.max_age]
+        for key in stale:
+            del self._tracks[key]
+
+    @staticmethod
+    def _match(previous, current):
+        """order[i] is the current color that continues previous color i"""
+        distances = np.linalg.norm(previous[:, None, :] - current[None, :, :], axis=2)
+        order = np.full(len(previous), -1)
+        taken = np.zeros(len(current), dtype=bool)
+        for flat in np.argsort(distances, axis=None):
+            i, j = divmod(int(flat), len(current))
+            if order[i] < 0 and not taken[j]:
+                order[i] = j
+                taken[j] = True
+        return order
+
+
+class StreamFrame():
+    def __init__(self, index, timestamp, image, reused=False):
+        self.index = index
+        self.timestamp = timestamp
+        self.image = image
+        self.reused = reused
+        self.items = None
+        self.cutouts = None
+        self.error = None
+
+
+class StreamProcessor():
+    """Runs frames through detect, segment and palette stages on their own threads"""
+
+    def __init__(self, bg_model=None, realtime=None, queue_size=STREAM_QUEUE_SIZE,
+                 reuse_threshold=STREAM_REUSE_THRESHOLD, smoothing=STREAM_SMOOTHING, max_side=STREAM_MAX_SIDE):
+        self.bg_model = bg_model
+        # None decides per source: cameras are live, files and iterables are processed frame by frame
+        self.realtime = realtime
+        self.queue_size = queue_size
+        self.reuse_threshold = reuse_threshold
+        self.max_side = max_side
+        self.smoother = PaletteSmoother(alpha=smoothing)
+        self.counts = {"read": 0, "analysed": 0, "reused": 0, "skipped": 0, "emitted": 0}
+        self._emitted_at = deque()
+        self._started = None
+        self._last_items = []
+        self._error = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def run(self, source):
+        """Yields one result dict per frame that made it through, in frame order"""
+        realtime = self.realtime
+        if realtime is None:
+            realtime = isinstance(source, int) or (isinstance(source, str) and source.isdigit())
+        decoded, detected, segmented, output = (queue.Queue(maxsize=self.queue_size) for _ in range(4))
+        stages = [
+            (self._read, (source, realtime, decoded), 'stream-decode'),
+            (self._stage, (self._detect, decoded, detected), 'stream-detect'),
+            (self._stage, (self._segment, detected, segmented), 'stream-segment'),
+            (self._stage, (self._palette, segmented, output), 'stream-palette'),
+        ]
+        self._stop.clear()
+        self._error = None
+        self._started = time.perf_counter()
+        for target, args, name in stages:
+            threading.Thread(target=target, args=args, name=name, daemon=True).start()
+        try:
+            while True:
+                frame = output.get()
+                if frame is _DONE:
+                    break
+                yield self._emit(frame)
+            if self._error is not None:
+                # The source itself failed, e.g. it could not be opened
+                raise self._error
+        finally:
+            # Also reached when the caller stops iterating; every stage polls _stop and exits
+            self._stop.set()
+
+    def _put(self, outbox, item):
+        while not self._stop.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _read(self, source, realtime, outbox):
+        last_signature = None
+        try:
+            for index, (media_time, image) in enumerate(iter_frames(source, self.max_side)):
+                if self._stop.is_set():
+                    return
+                if realtime and media_time is not None:
+                    # Play files back at their own frame rate, as a camera would deliver them
+                    delay = self._started + media_time - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                timestamp = media_time if media_time is not None else time.perf_counter() - self._started
+                signature = frame_signature(image)
+                reused = (last_signature is not None and
+                          float(np.abs(signature - last_signature).mean()) < self.reuse_threshold)
+                if not reused:
+                    last_signature = signature
+                self._count('read')
+                frame = StreamFrame(index, timestamp, None if reused else image, reused)
+                if realtime:
+                    self._offer(outbox, frame)
+                else:
+                    self._put(outbox, frame)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._put(outbox, _DONE)
+
+    def _offer(self, outbox, frame):
+        """Never blocks a live source: when the pipeline is behind, the oldest waiting frame is dropped"""
+        while True:
+            try:
+                outbox.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    dropped = outbox.get_nowait()
+                except queue.Empty:
+                    continue
+                self._count('skipped')
+                if frame.reused and not dropped.reused:
+                    # The frame this one would reuse never gets analysed, so analyse the new one instead
+                    frame.image, frame.reused = dropped.image, False
+
+    def _get(self, inbox):
+        # Polls, so a stage also ends when the consumer stopped early and no _DONE will arrive
+        while not self._stop.is_set():
+            try:
+                return inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _stage(self, fn, inbox, outbox):
+        while True:
+            frame = self._get(inbox)
+            if frame is _DONE:
+                self._put(outbox, _DONE)
+                return
+            if not frame.reused and frame.error is None:
+                try:
+                    fn(frame)
+                except Exception as e:
+                    frame.error = e
+            self._put(outbox, frame)
+
+    def _detect(self, frame):
+        frame.items = find_items(frame.image)
+
+    def _segment(self, frame):
+        frame.cutouts = cut_out_items(frame.image, frame.items, self.bg_model)
+        frame.image = None
+
+    def _palette(self, frame):
+        namer = model_registry.get('color_namer')
+        seen = {}
+        for item, cutout in zip(frame.items, frame.cutouts):
+            with stage('palette'):
+                colors, weights = extract_palette(cutout)
+            # Items of the same label are told apart by their rank, which is stable enough between frames
+            key = (item["label"], seen.get(item["label"], 0))
+            seen[item["label"]] = key[1] + 1
+            smoothed, smoothed_weights = self.smoother.update(key, colors, weights)
+            item["color_palette"] = ['#%02x%02x%02x' % tuple(int(round(c)) for c in color) for color in smoothed]
+            item["color_weights"] = [round(float(weight), 4) for weight in smoothed_weights]
+            item["color_names"] = namer.name_hex_colors(item["color_palette"])
+        self.smoother.next_frame()
+        frame.cutouts = None
+        self._count('analysed')
+
+    def _emit(self, frame):
+        now = time.perf_counter()
+        with self._lock:
+            self.counts["emitted"] += 1
+            if frame.reused:
+                self.counts["reused"] += 1
+            self._emitted_at.append(now)
+            while now - self._emitted_at[0] > FPS_WINDOW_SECONDS:
+                self._emitted_at.popleft()
+            window = min(now - self._started, FPS_WINDOW_SECONDS)
+            fps = len(self._emitted_at) / window if window > 0 else 0.0
+        result = {"frame": frame.index, "timestamp": round(frame.timestamp, 3), "reused": frame.reused,
+                  "fps": round(fps, 2)}
+        if frame.error is not None:
+            # One bad frame should not end a live stream
+            result["error"] = str(frame.error)
+            result["items"] = []
+            return result
+        if not frame.reused:
+            self._last_items = frame.items
+        result["items"] = self._last_items
+        return result
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        """Sustained rates since the stream started"""
+        elapsed = time.perf_counter() - self._started if self._started else 0.0
+        with self._lock:
+            counts = dict(self.counts)
+        rate = (lambda n: round(n / elapsed, 2)) if elapsed else (lambda n: 0.0)
+        return {
+            **counts,
+            "seconds": round(elapsed, 3),
+            "fps": rate(counts["emitted"]),
+            "analysed_fps": rate(counts["analysed"]),
+            "input_fps": rate(counts["read"]),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('source', help='camera index, video file or stream URL')
+    parser.add_argument('--realtime', action='store_true', help='play files back at their frame rate and skip frames')
+    parser.add_argument('--bg-model', help='background removal model variant')
+    parser.add_argument('--max-frames', type=int, help='stop after this many results')
+    parser.add_argument('--output', help='write one JSON line per frame here instead of stdout')
+    args = parser.parse_args(argv)
+
+    processor = StreamProcessor(bg_model=args.bg_model, realtime=True if args.realtime else None)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for i, result in enumerate(processor.run(args.source)):
+            out.write(json.dumps(result) + '\n')
+            if args.max_frames and i + 1 >= args.max_frames:
+                break
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(json.dumps(processor.stats()), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
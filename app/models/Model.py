@@ -2,43 +2,78 @@ import tensorflow as tf
 import matplotlib.pyplot as plt
 import numpy as np
 import cv2
-import pandas as pd
 import os
+import threading
+from app.models.feedback_store import FeedbackStore, convert_csv_dataset
+
 
 class FashionMNISTModel:
-    def __init__(self, model_path, feedback_path, train_path):
+    def __init__(self, model_path, feedback_path, train_path, retrain_every=5, replay_size=500, epochs=5):
         self.model_path = model_path
-        self.feedback_path = feedback_path
+        # Feedback and the training set live in append-only binary stores next to the CSVs
+        self.feedback_path = os.path.splitext(feedback_path)[0]
         self.train_path = os.path.abspath(train_path)
         self.model = tf.keras.models.load_model(model_path)
-        self.feedback_data = self.load_dataset(feedback_path)
-
-    def load_dataset(self, path):
-        if os.path.exists(path):
-            return pd.read_csv(path)
-        else:
-            return pd.DataFrame(columns=["label"] + [f"pixel{i}" for i in range(1, 785)])
-
-    def save_dataset(self, path, data):
-        data.to_csv(path, index=False)
+        self.feedback = FeedbackStore(self.feedback_path)
+        self.retrain_every = retrain_every
+        self.replay_size = replay_size
+        self.epochs = epochs
+        self._train_store = None
+        self._model_lock = threading.Lock()
+        self._retrain_thread = None
+
+    @property
+    def train_store(self):
+        # The training CSV is converted once, later runs only memory-map it
+        if self._train_store is None:
+            self._train_store = convert_csv_dataset(self.train_path, os.path.splitext(self.train_path)[0])
+        return self._train_store
+
+    def add_feedback(self, image, label):
+        self.feedback.append(image, label)
+        if self.feedback.pending() >= self.retrain_every:
+            self.retrain_in_background()
+
+    def replay_sample(self, rng):
+        """Random rows from the training set and older feedback, so updates don't forget"""
+        sources = [self.train_store.read(), self.feedback.read(0, self.feedback.trained_upto)]
+        sizes = np.array([len(labels) for _, labels in sources])
+        if sizes.sum() == 0:
+            return np.empty((0, 28, 28), dtype=np.uint8), np.empty(0, dtype=np.uint8)
+        picks = np.sort(rng.choice(sizes.sum(), size=min(self.replay_size, sizes.sum()), replace=False))
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        images, labels = [], []
+        for (source_images, source_labels), start, end in zip(sources, offsets[:-1], offsets[1:]):
+            rows = picks[(picks >= start) & (picks < end)] - start
+            images.append(source_images[rows])
+            labels.append(source_labels[rows])
+        return np.concatenate(images), np.concatenate(labels)
 
     def update_model(self, new_images, new_labels):
-       
         new_labels = tf.keras.utils.to_categorical(new_labels, num_classes=10)
-        self.model.fit(new_images, new_labels, epochs=5, validation_split=0.2)
-        self.model.train_on_batch(new_images, new_labels)
-        self.model.save(self.model_path)
-
-    def update_train_data(self, rows_to_move=5):
-        train_data = pd.read_csv(self.train_path)
-        feedback_rows = self.feedback_data.head(rows_to_move)
-        train_data = pd.concat([train_data, feedback_rows], ignore_index=True)
-        train_data.to_csv(self.train_path, index=False, mode='w', header=True) 
-        self.feedback_data = self.feedback_data.iloc[rows_to_move:, :]
-        self.save_dataset(self.feedback_path, self.feedback_data)
-
-
-
+        with self._model_lock:
+            self.model.fit(new_images, new_labels, epochs=self.epochs, verbose=0)
+            self.model.save(self.model_path)
+
+    def retrain(self):
+        """Trains on feedback not seen yet plus a replay sample, then moves the cursor"""
+        start, stop = self.feedback.trained_upto, len(self.feedback)
+        if stop <= start:
+            return False
+        fresh_images, fresh_labels = self.feedback.read(start, stop)
+        replay_images, replay_labels = self.replay_sample(np.random.default_rng())
+        images = np.concatenate([fresh_images, replay_images]).reshape(-1, 28, 28, 1).astype('float32') / 255.0
+        labels = np.concatenate([fresh_labels, replay_labels])
+        self.update_model(images, labels)
+        self.feedback.trained_upto = stop
+        return True
+
+    def retrain_in_background(self):
+        if self._retrain_thread is not None and self._retrain_thread.is_alive():
+            return False
+        self._retrain_thread = threading.Thread(target=self.retrain, name='fashion-mnist-retrain', daemon=True)
+        self._retrain_thread.start()
+        return True
 
     def process_image(self, image_path):
         new_image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
@@ -47,7 +82,8 @@ class FashionMNISTModel:
         return new_image
 
     def predict_image(self, new_image):
-        predicted_label = self.model.predict(new_image)
+        with self._model_lock:
+            predicted_label = self.model.predict(new_image, verbose=0)
         predicted_class = np.argmax(predicted_label)
         return predicted_class
 
@@ -69,23 +105,15 @@ class FashionMNISTModel:
 
             if user_response == "no":
                 correct_label = input("Please provide the correct label for the Fashion MNIST image: ")
-                self.feedback_data = pd.concat([self.feedback_data,
-                                               pd.DataFrame([{"label": int(correct_label) if correct_label else predicted_class,
-                                                              **{f"pixel{i}": val for i, val in enumerate(new_image.reshape(-1), start=1)}}])],
-                                              ignore_index=True)
-                self.save_dataset(self.feedback_path, self.feedback_data)
-
-                if len(self.feedback_data) >= 5:
-                    new_images = self.feedback_data.iloc[:, 1:].values.reshape(-1, 28, 28, 1)
-                    new_labels = self.feedback_data["label"].values
-
-                    new_images = new_images.astype('float32') / 255.0
-                    self.update_model(new_images, new_labels)
-                    self.update_train_data() 
-
-                    print("Model updated!")
+                self.add_feedback(new_image, int(correct_label) if correct_label else predicted_class)
+                if self._retrain_thread is not None and self._retrain_thread.is_alive():
+                    print("Updating the model in the background...")
 
+        if self._retrain_thread is not None:
+            self._retrain_thread.join()
         print("Thank you for your feedback!")
 
-fashion_mnist_model = FashionMNISTModel("fashion_mnist_model.keras", "feedback_data.csv", "fashion-mnist_train.csv")
-fashion_mnist_model.interact_with_user()
+
+if __name__ == "__main__":
+    fashion_mnist_model = FashionMNISTModel("fashion_mnist_model.keras", "feedback_data.csv", "fashion-mnist_train.csv")
+    fashion_mnist_model.interact_with_user()
@@ -0,0 +1,89 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from rembg import remove, new_session
+from dotenv import load_dotenv
+
+load_dotenv()
+REMBG_MODEL = os.getenv('REMBG_MODEL', 'u2net')
+REMBG_POOL_SIZE = int(os.getenv('REMBG_POOL_SIZE', 2))
+
+# Short names we accept from deployments and requests -> rembg model names
+MODEL_VARIANTS = {
+    'u2net': 'u2net',
+    'u2netp': 'u2netp',
+    'silueta': 'silueta',
+    'isnet': 'isnet-general-use',
+    'isnet-general-use': 'isnet-general-use',
+}
+
+
+class UnknownModelError(ValueError):
+    """Raised when a background-removal model variant is not supported"""
+
+
+class SessionPool():
+    """Keeps loaded rembg sessions per model and hands them out to one thread at a time"""
+
+    def __init__(self, pool_size=REMBG_POOL_SIZE, default_model=REMBG_MODEL):
+        self.pool_size = pool_size
+        self.default_model = resolve_model_name(default_model)
+        self._idle = {}
+        self._created = {}
+        self._lock = threading.Lock()
+
+    def _take(self, model_name):
+        with self._lock:
+            idle = self._idle.setdefault(model_name, queue.Queue())
+            try:
+                return idle.get_nowait()
+            except queue.Empty:
+                pass
+            can_create = self._created.get(model_name, 0) < self.pool_size
+            if can_create:
+                self._created[model_name] = self._created.get(model_name, 0) + 1
+        if can_create:
+            try:
+                return new_session(model_name)
+            except Exception:
+                with self._lock:
+                    self._created[model_name] -= 1
+                raise
+        # Pool is at capacity, wait for another thread to give a session back
+        return idle.get()
+
+    @contextmanager
+    def session(self, model=None):
+        model_name = resolve_model_name(model or self.default_model)
+        session = self._take(model_name)
+        try:
+            yield session
+        finally:
+            self._idle[model_name].put(session)
+
+    def preload(self, model=None):
+        with self.session(model):
+            pass
+        return self
+
+    def stats(self):
+        with self._lock:
+            return {name: {"created": created, "idle": self._idle[name].qsize()}
+                    for name, created in self._created.items()}
+
+
+def resolve_model_name(model):
+    try:
+        return MODEL_VARIANTS[model]
+    except KeyError:
+        raise UnknownModelError(f"Unknown background removal model '{model}', "
+                                f"choose one of {', '.join(sorted(MODEL_VARIANTS))}")
+
+
+session_pool = SessionPool()
+
+
+def remove_background(image, model=None, **kwargs):
+    with session_pool.session(model) as session:
+        return remove(image, session=session, **kwargs)
@@ -0,0 +1,170 @@
+import os
+import sys
+import glob
+import shutil
+import logging
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+# torch runs the .pt weights as they are, onnx and openvino export them once for CPU inference
+DETECTOR_BACKEND = os.getenv('DETECTOR_BACKEND', 'torch')
+DETECTOR_IMGSZ = int(os.getenv('DETECTOR_IMGSZ', 640))
+DETECTOR_THREADS = int(os.getenv('DETECTOR_THREADS', 0))
+DETECTOR_INT8 = os.getenv('DETECTOR_INT8', '0') == '1'
+# Fail loading when the exported model agrees with torch on fewer detections than this
+DETECTOR_PARITY_MIN = float(os.getenv('DETECTOR_PARITY_MIN', 0))
+
+logger = logging.getLogger(__name__)
+
+
+def exported_path(weights, backend, imgsz, int8):
+    stem = os.path.splitext(weights)[0]
+    suffix = f'_{imgsz}' + ('_int8' if int8 else '')
+    if backend == 'onnx':
+        return f'{stem}{suffix}.onnx'
+    return f'{stem}{suffix}_openvino_model'
+
+
+def export_model(weights, backend=DETECTOR_BACKEND, imgsz=DETECTOR_IMGSZ, int8=DETECTOR_INT8):
+    """Exports the .pt weights for the backend once and returns the exported model path"""
+    if backend == 'torch':
+        return weights
+    target = exported_path(weights, backend, imgsz, int8)
+    if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(weights):
+        return target
+
+    from ultralytics import YOLO
+    model = YOLO(weights)
+    if backend == 'onnx':
+        # Dynamic axes keep micro-batching possible
+        exported = model.export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+        if int8:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(exported, target, weight_type=QuantType.QUInt8)
+            os.remove(exported)
+        else:
+            shutil.move(exported, target)
+    elif backend == 'openvino':
+        exported = model.export(format='openvino', imgsz=imgsz, dynamic=True, int8=int8)
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        shutil.move(exported, target)
+    else:
+        raise ValueError(f"Unknown detector backend '{backend}', choose torch, onnx or openvino")
+    return target
+
+
+class Detector():
+    """YOLO on the chosen backend, always run at a fixed inference size"""
+
+    def __init__(self, weights, backend=DETECTOR_BACKEND, imgsz=DETECTOR_IMGSZ, threads=DETECTOR_THREADS,
+                 int8=DETECTOR_INT8):
+        from ultralytics import YOLO
+        self.backend = backend
+        self.imgsz = imgsz
+        self.threads = threads
+        if backend == 'torch' and threads:
+            import torch
+            torch.set_num_threads(threads)
+        self.path = export_model(weights, backend, imgsz, int8)
+        self.model = YOLO(self.path, task='detect')
+        self._threads_applied = backend == 'torch' or not threads
+
+    @property
+    def names(self):
+        return self.model.names
+
+    def __call__(self, images, **kwargs):
+        kwargs.setdefault('imgsz', self.imgsz)
+        results = self.model(images, **kwargs)
+        if not self._threads_applied:
+            # ultralytics builds the runtime session on the first call, limit its threads afterwards
+            self._apply_threads()
+        return results
+
+    def _apply_threads(self):
+        self._threads_applied = True
+        backend = getattr(getattr(self.model, 'predictor', None), 'model', None)
+        try:
+            if self.backend == 'onnx' and hasattr(backend, 'session'):
+                import onnxruntime as ort
+                options = ort.SessionOptions()
+                options.intra_op_num_threads = self.threads
+                backend.session = ort.InferenceSession(self.path, options,
+                                                       providers=backend.session.get_providers())
+            elif self.backend == 'openvino' and hasattr(backend, 'ov_compiled_model'):
+                import openvino as ov
+                xml = glob.glob(os.path.join(self.path, '*.xml'))[0]
+                backend.ov_compiled_model = ov.Core().compile_model(
+                    xml, 'AUTO', config={'INFERENCE_NUM_THREADS': self.threads})
+        except Exception:
+            logger.warning("Could not limit %s detector to %d threads", self.backend, self.threads, exc_info=True)
+
+
+def box_iou(a, b):
+    """IoU between every box in a (n, 4) and b (m, 4), xyxy"""
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return intersection / (area_a[:, None] + area_b[None, :] - intersection + 1e-9)
+
+
+def parity_check(reference, candidate, images, iou_threshold=0.5):
+    """Compares detections of two detectors, matching boxes of the same class by IoU"""
+    matched = missed = extra = 0
+    ious, confidence_deltas = [], []
+    for image in images:
+        ref = reference(image, verbose=False)[0].boxes.data.cpu().numpy()
+        cand = candidate(image, verbose=False)[0].boxes.data.cpu().numpy()
+        used = set()
+        for box in ref:
+            best, best_iou = None, iou_threshold
+            if len(cand):
+                overlaps = box_iou(box[None, :4], cand[:, :4])[0]
+                for j in np.argsort(overlaps)[::-1]:
+                    if j not in used and cand[j, 5] == box[5] and overlaps[j] >= best_iou:
+                        best, best_iou = j, overlaps[j]
+                        break
+            if best is None:
+                missed += 1
+                continue
+            used.add(best)
+            matched += 1
+            ious.append(float(best_iou))
+            confidence_deltas.append(abs(float(cand[best, 4] - box[4])))
+        extra += len(cand) - len(used)
+    total = matched + missed + extra
+    return {
+        "images": len(images),
+        "matched": matched,
+        "missed": missed,
+        "extra": extra,
+        "agreement": matched / total if total else 1.0,
+        "mean_iou": float(np.mean(ious)) if ious else None,
+        "max_confidence_delta": max(confidence_deltas) if confidence_deltas else None,
+    }
+
+
+def load_detector(weights):
+    detector = Detector(weights)
+    if detector.backend != 'torch' and DETECTOR_PARITY_MIN > 0:
+        from app.models.registry import warmup_samples, WARMUP_IMAGES
+        report = parity_check(Detector(weights, backend='torch'), detector, warmup_samples(WARMUP_IMAGES))
+        logger.info("Detector parity against torch: %s", report)
+        if report["agreement"] < DETECTOR_PARITY_MIN:
+            raise RuntimeError(f"{detector.backend} detector agrees on {report['agreement']:.2%} of detections, "
+                               f"below DETECTOR_PARITY_MIN={DETECTOR_PARITY_MIN}")
+    return detector
+
+
+if __name__ == '__main__':
+    # python -m app.models.detector weights.pt [image_dir]: export and compare against torch
+    import json
+    from app.models.registry import warmup_samples
+    weights = sys.argv[1]
+    image_dir = sys.argv[2] if len(sys.argv) > 2 else os.path.join('data', 'sample_images')
+    reference = Detector(weights, backend='torch')
+    print(json.dumps(parity_check(reference, Detector(weights), warmup_samples(image_dir)), indent=2))
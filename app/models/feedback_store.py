@@ -0,0 +1,88 @@
+import os
+import threading
+import numpy as np
+
+IMAGE_SIZE = 28 * 28
+
+
+class FeedbackStore():
+    """Append-only uint8 images and labels on disk, read back through memory maps"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.images_path = os.path.join(directory, 'images.u8')
+        self.labels_path = os.path.join(directory, 'labels.u8')
+        self.cursor_path = os.path.join(directory, 'trained_upto')
+        self._lock = threading.Lock()
+        self._repair()
+
+    def _repair(self):
+        # A crash between the two appends can leave one file a row ahead
+        rows = min(os.path.getsize(self.images_path) // IMAGE_SIZE if os.path.exists(self.images_path) else 0,
+                   os.path.getsize(self.labels_path) if os.path.exists(self.labels_path) else 0)
+        for path, row_size in ((self.images_path, IMAGE_SIZE), (self.labels_path, 1)):
+            with open(path, 'ab') as f:
+                f.truncate(rows * row_size)
+
+    def __len__(self):
+        return os.path.getsize(self.labels_path)
+
+    def append(self, image, label):
+        """Stores one 28x28 image (uint8, or floats in [0, 1]) with its label"""
+        image = np.asarray(image)
+        if image.dtype != np.uint8:
+            image = np.clip(np.rint(image * 255.0), 0, 255).astype(np.uint8)
+        image = image.reshape(IMAGE_SIZE)
+        with self._lock:
+            with open(self.images_path, 'ab') as f:
+                f.write(image.tobytes())
+            with open(self.labels_path, 'ab') as f:
+                f.write(bytes([int(label)]))
+
+    def read(self, start=0, stop=None):
+        """Returns (images, labels) memory maps for rows start..stop"""
+        rows = len(self)
+        stop = rows if stop is None else min(stop, rows)
+        if stop <= start:
+            return np.empty((0, 28, 28), dtype=np.uint8), np.empty(0, dtype=np.uint8)
+        images = np.memmap(self.images_path, dtype=np.uint8, mode='r', shape=(rows, 28, 28))
+        labels = np.memmap(self.labels_path, dtype=np.uint8, mode='r', shape=(rows,))
+        return images[start:stop], labels[start:stop]
+
+    @property
+    def trained_upto(self):
+        try:
+            with open(self.cursor_path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    @trained_upto.setter
+    def trained_upto(self, rows):
+        tmp_path = f'{self.cursor_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(rows))
+        os.replace(tmp_path, self.cursor_path)
+
+    def pending(self):
+        return len(self) - self.trained_upto
+
+
+def convert_csv_dataset(csv_path, directory, chunk_size=10000):
+    """One-off conversion of a label,pixel1..pixel784 CSV into a FeedbackStore"""
+    import pandas as pd
+    store = FeedbackStore(directory)
+    if len(store):
+        return store
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_size):
+        values = chunk.to_numpy()
+        pixels = values[:, 1:]
+        if pixels.max() <= 1.0:
+            pixels = pixels * 255.0
+        with open(store.images_path, 'ab') as f:
+            f.write(np.clip(np.rint(pixels), 0, 255).astype(np.uint8).tobytes())
+        with open(store.labels_path, 'ab') as f:
+            f.write(values[:, 0].astype(np.uint8).tobytes())
+    store.trained_upto = len(store)
+    return store
@@ -0,0 +1,141 @@
+import os
+import glob
+import time
+import logging
+import threading
+from PIL import Image
+from dotenv import load_dotenv
+from app.utils.metrics import register_collector
+
+load_dotenv()
+# lazy loads on first use, startup loads and warms up in the startup hook,
+# preload loads at import (before gunicorn forks) and warms up in each worker
+MODEL_LOAD_MODE = os.getenv('MODEL_LOAD_MODE', 'startup')
+WARMUP_IMAGES = os.getenv('WARMUP_IMAGES', os.path.join('data', 'sample_images'))
+WARMUP_RUNS = int(os.getenv('WARMUP_RUNS', 1))
+
+logger = logging.getLogger(__name__)
+
+
+class ModelEntry():
+    def __init__(self, name, loader, warmup=None, fork_safe=True):
+        self.name = name
+        self.loader = loader
+        self.warmup = warmup
+        self.fork_safe = fork_safe
+        self.model = None
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self.error = None
+        self.lock = threading.Lock()
+
+
+class ModelRegistry():
+    """Loads each model once, on first use or ahead of time, and tracks readiness"""
+
+    def __init__(self):
+        self._entries = {}
+        self._warming = False
+        self.warmed_up = False
+
+    def register(self, name, loader, warmup=None, fork_safe=True):
+        """warmup, if given, is called with (model, sample_image).
+        Models that start native thread pools when loaded should pass fork_safe=False."""
+        self._entries[name] = ModelEntry(name, loader, warmup, fork_safe)
+
+    def get(self, name):
+        entry = self._entries[name]
+        if entry.model is None:
+            with entry.lock:
+                if entry.model is None:
+                    started = time.perf_counter()
+                    try:
+                        entry.model = entry.loader()
+                    except Exception as e:
+                        entry.error = str(e)
+                        raise
+                    entry.error = None
+                    entry.load_seconds = time.perf_counter() - started
+                    logger.info("Loaded %s in %.2fs", name, entry.load_seconds)
+        return entry.model
+
+    def load_all(self, fork_safe_only=False):
+        for entry in self._entries.values():
+            if entry.fork_safe or not fork_safe_only:
+                self.get(entry.name)
+
+    def warmup_all(self, image_dir=WARMUP_IMAGES, runs=WARMUP_RUNS):
+        """Runs each model on the sample images so the first request does not pay for it"""
+        self._warming = True
+        try:
+            samples = warmup_samples(image_dir)
+            failed = False
+            for entry in self._entries.values():
+                try:
+                    model = self.get(entry.name)
+                    if entry.warmup is None or not samples:
+                        continue
+                    started = time.perf_counter()
+                    for _ in range(runs):
+                        for sample in samples:
+                            entry.warmup(model, sample)
+                    entry.warmup_seconds = time.perf_counter() - started
+                except Exception as e:
+                    # Keep going so one broken model does not hide the state of the others
+                    logger.exception("Warmup of %s failed", entry.name)
+                    entry.error = str(e)
+                    failed = True
+            self.warmed_up = not failed
+        finally:
+            self._warming = False
+
+    def loaded(self):
+        return all(entry.model is not None for entry in self._entries.values())
+
+    def ready(self):
+        if MODEL_LOAD_MODE == 'lazy':
+            return not self._warming
+        return self.loaded() and self.warmed_up
+
+    def status(self):
+        return {
+            "mode": MODEL_LOAD_MODE,
+            "ready": self.ready(),
+            "warmed_up": self.warmed_up,
+            "models": {
+                entry.name: {
+                    "loaded": entry.model is not None,
+                    "load_seconds": entry.load_seconds,
+                    "warmup_seconds": entry.warmup_seconds,
+                    "error": entry.error,
+                }
+                for entry in self._entries.values()
+            },
+        }
+
+
+def warmup_samples(image_dir):
+    samples = []
+    for path in sorted(glob.glob(os.path.join(image_dir, '*'))):
+        try:
+            with Image.open(path) as image:
+                samples.append(image.convert('RGB'))
+        except OSError:
+            continue
+    return samples
+
+
+model_registry = ModelRegistry()
+
+
+@register_collector
+def model_metrics():
+    lines = ['# HELP model_load_seconds Time it took to load each model',
+             '# TYPE model_load_seconds gauge']
+    for name, status in model_registry.status()["models"].items():
+        if status["load_seconds"] is not None:
+            lines.append(f'model_load_seconds{{model="{name}"}} {status["load_seconds"]}')
+    lines += ['# HELP models_ready Whether all models are loaded and warmed up',
+              '# TYPE models_ready gauge',
+              f'models_ready {int(model_registry.ready())}']
+    return lines
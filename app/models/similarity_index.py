@@ -0,0 +1,155 @@
+import os
+import fcntl
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive flock on path. Each call opens its own handle, so it also excludes other threads;
+    don't nest two calls on the same path in one thread."""
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class SimilarityIndex():
+    """Append-only float32 vectors with string ids on disk, searched through a memory map.
+    Adding an id again replaces its earlier vector. Several processes may share a directory:
+    appends hold an exclusive file lock, and each process picks up rows others added."""
+
+    def __init__(self, directory, dim):
+        self.directory = directory
+        self.dim = dim
+        os.makedirs(directory, exist_ok=True)
+        self.vectors_path = os.path.join(directory, 'vectors.f32')
+        # One int32 per row that queries can filter on, e.g. the class slot, -1 for none
+        self.groups_path = os.path.join(directory, 'groups.i32')
+        # Written last, so a row exists for readers once its id line is complete
+        self.ids_path = os.path.join(directory, 'ids.txt')
+        self.lock_path = os.path.join(directory, 'lock')
+        self._lock = threading.RLock()
+        self._ids = []
+        self._ids_size = 0
+        self._row_of = {}
+        # Rows whose id was added again later
+        self._stale = set()
+        self._vectors = None
+        self._groups = None
+        with self.locked():
+            self._repair()
+            self._refresh()
+
+    @contextmanager
+    def locked(self):
+        """Exclusive across threads and processes using this directory"""
+        with self._lock:
+            with file_lock(self.lock_path):
+                yield
+
+    def _repair(self):
+        # A crash between the three appends can leave the files at different row counts
+        for path in (self.vectors_path, self.groups_path, self.ids_path):
+            open(path, 'ab').close()
+        with open(self.ids_path, 'rb') as f:
+            raw = f.read()
+        ids = raw.decode('utf-8').splitlines()
+        rows = min(os.path.getsize(self.vectors_path) // (self.dim * 4),
+                   os.path.getsize(self.groups_path) // 4, len(ids))
+        for path, row_size in ((self.vectors_path, self.dim * 4), (self.groups_path, 4)):
+            with open(path, 'ab') as f:
+                f.truncate(rows * row_size)
+        if len(ids) != rows or (raw and not raw.endswith(b'\n')):
+            tmp_path = f'{self.ids_path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.writelines(f'{item_id}\n' for item_id in ids[:rows])
+            os.replace(tmp_path, self.ids_path)
+
+    def _refresh(self):
+        """Reads id lines appended since the last call, by this or another process"""
+        with self._lock:
+            size = os.path.getsize(self.ids_path)
+            if size == self._ids_size:
+                return
+            with open(self.ids_path, 'rb') as f:
+                f.seek(self._ids_size)
+                tail = f.read(size - self._ids_size)
+            # A line still being written by another process is picked up next time
+            complete = tail[:tail.rfind(b'\n') + 1]
+            self._ids_size += len(complete)
+            for item_id in complete.decode('utf-8').splitlines():
+                self._ids.append(item_id)
+                self._replace(item_id, len(self._ids) - 1)
+
+    def _replace(self, item_id, row):
+        previous = self._row_of.get(item_id)
+        if previous is not None:
+            self._stale.add(previous)
+        self._row_of[item_id] = row
+
+    def __len__(self):
+        self._refresh()
+        return len(self._row_of)
+
+    def __contains__(self, item_id):
+        self._refresh()
+        return item_id in self._row_of
+
+    def add_many(self, ids, vectors, groups=None):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        groups = np.full(len(vectors), -1, dtype=np.int32) if groups is None else np.asarray(groups, dtype=np.int32)
+        if not len(ids) == len(vectors) == len(groups):
+            raise ValueError("ids, vectors and groups must have the same length")
+        for item_id in ids:
+            if not item_id or '\n' in item_id or '\r' in item_id:
+                raise ValueError(f"Invalid item id {item_id!r}")
+        with self.locked():
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self.groups_path, 'ab') as f:
+                f.write(groups.tobytes())
+            with open(self.ids_path, 'a', encoding='utf-8') as f:
+                f.writelines(f'{item_id}\n' for item_id in ids)
+            self._refresh()
+
+    def add(self, item_id, vector, group=-1):
+        self.add_many([item_id], [vector], [group])
+
+    def _snapshot(self):
+        with self._lock:
+            self._refresh()
+            rows = len(self._ids)
+            if self._vectors is None or len(self._vectors) != rows:
+                # Reopened only after inserts, the maps stay valid for rows already written
+                if rows:
+                    self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+                    self._groups = np.memmap(self.groups_path, dtype=np.int32, mode='r', shape=(rows,))
+                else:
+                    self._vectors = np.empty((0, self.dim), dtype=np.float32)
+                    self._groups = np.empty(0, dtype=np.int32)
+            return self._vectors, self._groups, list(self._stale)
+
+    def search(self, vector, k=10, group=None, exclude=(), min_score=None):
+        """Top k (id, score) by dot product with vector, best first"""
+        vectors, groups, stale = self._snapshot()
+        if not len(vectors) or k <= 0:
+            return []
+        scores = vectors @ np.asarray(vector, dtype=np.float32)
+        if stale:
+            scores[stale] = -np.inf
+        if group is not None:
+            scores[groups != group] = -np.inf
+        for item_id in exclude:
+            row = self._row_of.get(item_id)
+            if row is not None and row < len(scores):
+                scores[row] = -np.inf
+        if min_score is not None:
+            scores[scores < min_score] = -np.inf
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self._ids[row], float(scores[row])) for row in top if np.isfinite(scores[row])]
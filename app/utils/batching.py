@@ -0,0 +1,88 @@
+import threading
+import time
+import queue
+from concurrent.futures import Future
+
+
+class MicroBatcher():
+    """Collects single items from many threads and runs them through one batched call"""
+
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=10, name='batcher'):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {"batches": 0, "items": 0, "max_batch_size": 0,
+                       "total_batch_seconds": 0.0, "total_wait_seconds": 0.0}
+        self._thread = None
+
+    def _ensure_started(self):
+        # The worker thread is started lazily so a forked worker gets its own
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit(self, item):
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _, _ in batch]
+            started = time.perf_counter()
+            try:
+                results = self.batch_fn(items)
+                if len(results) != len(items):
+                    raise RuntimeError(f'{self.name} returned {len(results)} results for {len(items)} items')
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                results = None
+            finished = time.perf_counter()
+            if results is not None:
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            self._record(batch, started, finished)
+
+    def _record(self, batch, started, finished):
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["items"] += len(batch)
+            self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(batch))
+            self._stats["total_batch_seconds"] += finished - started
+            self._stats["total_wait_seconds"] += sum(started - queued for _, _, queued in batch)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        batches = stats["batches"] or 1
+        items = stats["items"] or 1
+        stats["mean_batch_size"] = stats["items"] / batches
+        stats["mean_batch_ms"] = stats["total_batch_seconds"] * 1000 / batches
+        stats["mean_wait_ms"] = stats["total_wait_seconds"] * 1000 / items
+        stats["queued"] = self._queue.qsize()
+        stats["max_batch_size_limit"] = self.max_batch_size
+        stats["max_wait_ms"] = self.max_wait * 1000
+        return stats
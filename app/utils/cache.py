@@ -0,0 +1,191 @@
+import os
+import json
+import asyncio
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 1024))
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL', 7 * 24 * 3600))
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', '')
+RESULT_CACHE_DISK_MAX_BYTES = int(os.getenv('RESULT_CACHE_DISK_MAX_BYTES', 256 * 1024 * 1024))
+# Share of the limit the disk tier is trimmed down to once it goes over
+RESULT_CACHE_DISK_LOW_WATER = float(os.getenv('RESULT_CACHE_DISK_LOW_WATER', 0.9))
+
+
+def content_key(data, *variant):
+    """Hash of the uploaded bytes, plus anything else that changes the result"""
+    digest = hashlib.sha256(data)
+    for part in variant:
+        if part:
+            digest.update(b'\0' + str(part).encode())
+    return digest.hexdigest()
+
+
+class ResultCache():
+    """In-memory LRU in front of an optional directory of JSON files"""
+
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL,
+                 cache_dir=RESULT_CACHE_DIR, disk_max_bytes=RESULT_CACHE_DISK_MAX_BYTES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        # Bytes in cache_dir, measured on first use and kept up to date by stores and evictions
+        self._disk_bytes = None
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "disk_evictions": 0}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _expired(self, stored_at):
+        return self.ttl and time.time() - stored_at > self.ttl
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def get(self, key):
+        value = self._get_memory(key)
+        return value if value is not None else self._get_slow(key)
+
+    async def get_async(self, key):
+        """get() for callers on the event loop, the disk tier is read on a worker thread"""
+        value = self._get_memory(key)
+        if value is not None:
+            return value
+        if self.cache_dir:
+            return await asyncio.to_thread(self._get_slow, key)
+        return self._get_slow(key)
+
+    def _get_memory(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if not self._expired(stored_at):
+                    self._memory.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+        return None
+
+    def _get_slow(self, key):
+        value = self._get_from_disk(key)
+        with self._lock:
+            if value is None:
+                self._counters["misses"] += 1
+                return None
+            self._counters["disk_hits"] += 1
+            self._put_memory(key, value)
+        return value
+
+    def _get_from_disk(self, key):
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            if self._expired(stat.st_mtime):
+                os.remove(path)
+                self._add_disk_bytes(-stat.st_size)
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        self._set_memory(key, value)
+        if self.cache_dir:
+            self._set_disk(key, value)
+
+    async def set_async(self, key, value):
+        """set() for callers on the event loop, the disk tier is written on a worker thread"""
+        self._set_memory(key, value)
+        if self.cache_dir:
+            await asyncio.to_thread(self._set_disk, key, value)
+
+    def _set_memory(self, key, value):
+        with self._lock:
+            self._put_memory(key, value)
+            self._counters["stores"] += 1
+
+    def _set_disk(self, key, value):
+        # Write then rename so readers never see a half-written file
+        path = self._path(key)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(value, f)
+        size = os.path.getsize(tmp_path)
+        try:
+            size -= os.path.getsize(path)
+        except OSError:
+            pass
+        os.replace(tmp_path, path)
+        if self._add_disk_bytes(size) > self.disk_max_bytes:
+            self._evict_disk()
+
+    def _put_memory(self, key, value):
+        self._memory[key] = (time.time(), value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _add_disk_bytes(self, size):
+        """Keeps a running total of the directory size, returns it. The first call measures it."""
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.cache_dir)
+                                       if entry.name.endswith('.json'))
+            else:
+                self._disk_bytes += size
+            return self._disk_bytes
+
+    def _evict_disk(self):
+        # Only runs once the running total passes the limit. Other processes sharing the directory
+        # are not counted in it, so the directory is measured again here.
+        with self._evict_lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.cache_dir):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            # Down to a low-water mark, so the next scan is many stores away
+            target = self.disk_max_bytes * RESULT_CACHE_DISK_LOW_WATER
+            if total > self.disk_max_bytes:
+                # Oldest entries go first until the directory fits again
+                for mtime, size, path in sorted(entries):
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+                    total -= size
+                    with self._lock:
+                        self._counters["disk_evictions"] += 1
+            with self._lock:
+                self._disk_bytes = total
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        stats["disk_enabled"] = bool(self.cache_dir)
+        return stats
+
+
+result_cache = ResultCache()
@@ -0,0 +1,107 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+EXECUTOR_KIND = os.getenv('PIPELINE_EXECUTOR', 'thread')
+EXECUTOR_WORKERS = int(os.getenv('PIPELINE_WORKERS', os.cpu_count() or 1))
+EXECUTOR_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', EXECUTOR_WORKERS * 4))
+RETRY_AFTER_SECONDS = int(os.getenv('PIPELINE_RETRY_AFTER', 5))
+
+
+class QueueFullError(Exception):
+    """Raised when the executor already holds as many jobs as it may queue"""
+
+
+def _init_process_worker(status_queue):
+    # Models load here, in each worker, never in the API process that forked it
+    from app.api import recognize_clothe_and_color  # noqa: F401, registers the models
+    from app.models.registry import model_registry, MODEL_LOAD_MODE
+    if MODEL_LOAD_MODE != 'lazy':
+        model_registry.warmup_all()
+    status_queue.put((os.getpid(), model_registry.status()))
+
+
+def _noop():
+    return os.getpid()
+
+
+class BoundedExecutor():
+    """Thread or process pool that refuses work instead of queueing without limit"""
+
+    def __init__(self, kind=EXECUTOR_KIND, max_workers=EXECUTOR_WORKERS, queue_size=EXECUTOR_QUEUE_SIZE):
+        # pid -> model registry status, reported by process workers once they have warmed up
+        self.worker_status = {}
+        if kind == 'process':
+            context = multiprocessing.get_context()
+            self._status_queue = context.Queue()
+            self.pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                                            initializer=_init_process_worker, initargs=(self._status_queue,))
+            threading.Thread(target=self._collect_status, name='executor-status', daemon=True).start()
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pipeline')
+        self.kind = kind
+        self.max_workers = max_workers
+        # Jobs running on the workers plus jobs waiting for one
+        self.capacity = max_workers + queue_size
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._pending >= self.capacity:
+                raise QueueFullError(f'{self._pending} jobs already pending')
+            self._pending += 1
+        try:
+            future = self.pool.submit(fn, *args, **kwargs)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _collect_status(self):
+        while True:
+            try:
+                pid, status = self._status_queue.get()
+            except (EOFError, OSError):
+                return
+            self.worker_status[pid] = status
+
+    def start_workers(self):
+        """Makes a process pool start all its workers now, so they warm up before traffic arrives"""
+        if self.kind == 'process':
+            for _ in range(self.max_workers):
+                self.pool.submit(_noop)
+
+    def status(self):
+        """Model readiness of the process workers"""
+        workers = dict(self.worker_status)
+        return {
+            "mode": "process",
+            "ready": len(workers) >= self.max_workers and all(status["ready"] for status in workers.values()),
+            "workers": {str(pid): status for pid, status in workers.items()},
+        }
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def stats(self):
+        with self._lock:
+            pending = self._pending
+        return {
+            "kind": self.kind,
+            "workers": self.max_workers,
+            "capacity": self.capacity,
+            "pending": pending,
+            "queued": max(0, pending - self.max_workers),
+        }
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+
+pipeline_executor = BoundedExecutor()
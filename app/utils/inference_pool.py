@@ -0,0 +1,290 @@
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import Future, InvalidStateError
+from PIL import Image
+from dotenv import load_dotenv
+from app.utils.ingest import decode_image
+from app.utils.metrics import stage, run_collected, register_collector
+from app.utils.executor import QueueFullError
+
+load_dotenv()
+# 0 keeps inference inside the API process; above that the models only live in these workers,
+# so run uvicorn with few workers and size INFERENCE_WORKERS for model memory and cores
+INFERENCE_WORKERS = int(os.getenv('INFERENCE_WORKERS', 0))
+# Requests each worker handles at once, more than one lets the detector batch them
+INFERENCE_THREADS = int(os.getenv('INFERENCE_THREADS', 2))
+INFERENCE_QUEUE_SIZE = int(os.getenv('INFERENCE_QUEUE_SIZE', INFERENCE_WORKERS * INFERENCE_THREADS * 2))
+HEALTH_CHECK_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceError(RuntimeError):
+    """Raised when a worker fails on a frame or dies while holding it"""
+
+
+class SharedFrame():
+    """A decoded RGB image in a shared memory block, workers attach to it by name"""
+
+    def __init__(self, shm, size):
+        self.shm = shm
+        self.size = size
+
+    @classmethod
+    def from_image(cls, image):
+        data = image.tobytes()
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        shm.buf[:len(data)] = data
+        return cls(shm, image.size)
+
+    @classmethod
+    def decode(cls, image_bytes):
+        with stage('decode'):
+            image = decode_image(image_bytes)
+        return cls.from_image(image)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _read_frame(name, size):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        # Pillow keeps RGB at 4 bytes per pixel, so unpacking the block is the one copy the
+        # worker makes and the image holds no view of it. The pixels never go through pickle.
+        return Image.frombuffer('RGB', size, shm.buf, 'raw', 'RGB', 0, 1)
+    finally:
+        shm.close()
+
+
+def _worker_main(index, tasks, results, threads):
+    # Imported here so models are only ever loaded in the worker processes
+    from app.api.recognize_clothe_and_color import analyse_image
+    from app.models.registry import model_registry, MODEL_LOAD_MODE
+    if MODEL_LOAD_MODE != 'lazy':
+        model_registry.warmup_all()
+    results.put(('ready', index, model_registry.status()))
+
+    def serve():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            task_id, name, size, public_id, bg_model, annotate, profile = task
+            results.put(('started', task_id, index))
+            try:
+                image = _read_frame(name, size)
+                outcome = run_collected(analyse_image, image, public_id, bg_model, annotate, profile=profile)
+            except Exception as e:
+                results.put(('failed', task_id, str(e)))
+            else:
+                results.put(('done', task_id, outcome))
+
+    handlers = [threading.Thread(target=serve, name=f'inference-{index}-{i}') for i in range(threads)]
+    for handler in handlers:
+        handler.start()
+    for handler in handlers:
+        handler.join()
+
+
+class InferencePool():
+    """Fixed set of processes that own the models. Frames reach them through shared memory
+    and only the task description and the compact result cross the queues."""
+
+    def __init__(self, workers=INFERENCE_WORKERS, threads=INFERENCE_THREADS, queue_size=INFERENCE_QUEUE_SIZE):
+        self.workers = workers
+        self.threads = threads
+        self.capacity = workers * threads + queue_size
+        # Spawned, not forked, so no model or runtime thread pool state leaks in from the API process
+        self._context = multiprocessing.get_context('spawn')
+        self._tasks = None
+        self._results = None
+        self._processes = []
+        self._worker_status = {}
+        self._running = {}
+        self._pending = {}
+        self._next_id = 0
+        self._restarts = 0
+        self._closed = False
+        self._listener = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def start(self):
+        with self._lock:
+            if self._listener is not None or not self.enabled:
+                return
+            self._tasks = self._context.Queue()
+            self._results = self._context.Queue()
+            self._processes = [self._spawn(index) for index in range(self.workers)]
+            self._listener = threading.Thread(target=self._listen, name='inference-results', daemon=True)
+            self._listener.start()
+
+    def _spawn(self, index):
+        process = self._context.Process(target=_worker_main, name=f'inference-{index}',
+                                        args=(index, self._tasks, self._results, self.threads), daemon=True)
+        process.start()
+        self._worker_status[index] = None
+        self._running[index] = set()
+        return process
+
+    def full(self):
+        with self._lock:
+            return len(self._pending) >= self.capacity
+
+    def submit(self, frame, public_id, bg_model=None, annotate=False, profile=False):
+        """Queues a frame, returns a Future of (result, observations, profile text).
+        The pool owns the frame from here on and releases it once the worker is done."""
+        try:
+            self.start()
+        except Exception:
+            frame.release()
+            raise
+        future = Future()
+        with self._lock:
+            if len(self._pending) >= self.capacity:
+                frame.release()
+                raise QueueFullError(f'{len(self._pending)} frames already pending')
+            task_id = self._next_id
+            self._next_id += 1
+            self._pending[task_id] = (future, frame)
+        self._tasks.put((task_id, frame.name, frame.size, public_id, bg_model, annotate, profile))
+        return future
+
+    def _listen(self):
+        last_check = time.monotonic()
+        while not self._closed:
+            try:
+                message = self._results.get(timeout=HEALTH_CHECK_INTERVAL)
+            except queue.Empty:
+                message = None
+            except (EOFError, OSError):
+                return
+            # One bad message or failed restart must not stop results from being delivered
+            if message is not None:
+                try:
+                    self._handle(message)
+                except Exception:
+                    logger.exception("Could not handle inference result %r", message[:2])
+            if time.monotonic() - last_check >= HEALTH_CHECK_INTERVAL:
+                last_check = time.monotonic()
+                try:
+                    self._check_workers()
+                except Exception:
+                    logger.exception("Inference worker health check failed")
+
+    def _handle(self, message):
+        kind, key, payload = message
+        if kind == 'ready':
+            with self._lock:
+                self._worker_status[key] = payload
+            return
+        if kind == 'started':
+            with self._lock:
+                if key in self._pending:
+                    self._running[payload].add(key)
+            return
+        if kind == 'done':
+            self._finish(key, result=payload)
+        else:
+            self._finish(key, error=InferenceError(payload))
+
+    def _finish(self, task_id, result=None, error=None):
+        with self._lock:
+            entry = self._pending.pop(task_id, None)
+            for running in self._running.values():
+                running.discard(task_id)
+        if entry is None:
+            return
+        future, frame = entry
+        frame.release()
+        if future.cancelled():
+            # The caller went away (e.g. a batch client disconnected), nobody is waiting for this
+            return
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            # Cancelled between the check and here
+            pass
+
+    def _check_workers(self):
+        for index, process in enumerate(self._processes):
+            if process.is_alive() or self._closed:
+                continue
+            logger.error("Inference worker %d exited with %s, restarting it", index, process.exitcode)
+            with self._lock:
+                lost = list(self._running[index])
+            for task_id in lost:
+                self._finish(task_id, error=InferenceError(f'Inference worker exited with {process.exitcode}'))
+            with self._lock:
+                self._restarts += 1
+                self._processes[index] = self._spawn(index)
+
+    def ready(self):
+        with self._lock:
+            return bool(self._processes) and all(status is not None and status["ready"]
+                                                 for status in self._worker_status.values())
+
+    def status(self):
+        ready = self.ready()
+        with self._lock:
+            workers = {str(index): status for index, status in self._worker_status.items()}
+        return {"mode": "inference_pool", "ready": ready, "workers": workers}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "threads": self.threads,
+                "alive": sum(process.is_alive() for process in self._processes),
+                "capacity": self.capacity,
+                "pending": len(self._pending),
+                "running": sum(len(running) for running in self._running.values()),
+                "restarts": self._restarts,
+            }
+
+    def shutdown(self, timeout=10):
+        if self._listener is None:
+            return
+        self._closed = True
+        for _ in range(self.workers * self.threads):
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        with self._lock:
+            pending = list(self._pending)
+        for task_id in pending:
+            self._finish(task_id, error=InferenceError('Inference pool shut down'))
+
+
+inference_pool = InferencePool()
+
+
+@register_collector
+def inference_metrics():
+    if not inference_pool.enabled:
+        return []
+    stats = inference_pool.stats()
+    return [
+        '# TYPE inference_workers_alive gauge', f'inference_workers_alive {stats["alive"]}',
+        '# TYPE inference_pending gauge', f'inference_pending {stats["pending"]}',
+        '# TYPE inference_worker_restarts_total counter', f'inference_worker_restarts_total {stats["restarts"]}',
+    ]
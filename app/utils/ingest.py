@@ -0,0 +1,33 @@
+import os
+from io import BytesIO
+from PIL import Image, ImageOps
+from dotenv import load_dotenv
+from app.utils.metrics import observe
+
+load_dotenv()
+INGEST_MAX_SIDE = int(os.getenv('INGEST_MAX_SIDE', 1024))
+
+
+def decode_image(image_bytes, max_side=INGEST_MAX_SIDE):
+    """Decodes an upload once into an RGB image no larger than max_side.
+    image_bytes may also be a file-like buffer such as an mmap of the spooled upload."""
+    if isinstance(image_bytes, (bytes, bytearray, memoryview)):
+        image = Image.open(BytesIO(image_bytes))
+    else:
+        image_bytes.seek(0)
+        image = Image.open(image_bytes)
+    observe('image_pixels', None, image.size[0] * image.size[1])
+    if max_side and image.format == 'JPEG':
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale instead of full resolution
+        image.draft('RGB', (max_side, max_side))
+    if image.getexif().get(0x0112, 1) != 1:
+        # Phone photos store rotation in EXIF, apply it once here
+        image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.BILINEAR)
+    # An RGB JPEG within max_side is still lazy here; decode now, on the caller's thread,
+    # rather than on whichever thread first touches the pixels (e.g. the one batching detections)
+    image.load()
+    return image
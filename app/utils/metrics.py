@@ -0,0 +1,229 @@
+import os
+import io
+import time
+import random
+import pstats
+import cProfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 20))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = (64e3, 256e3, 1e6, 2e6, 4e6, 8e6, 16e6, 32e6)
+PIXELS_BUCKETS = (0.3e6, 1e6, 2e6, 4e6, 8e6, 12e6, 24e6, 48e6)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter():
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_values, value in self._values.items():
+                lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, *label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f'# TYPE {self.name} gauge'
+        return lines
+
+
+class Histogram():
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, *label_values, value):
+        with self._lock:
+            counts, total, count = self._values.get(label_values, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[label_values] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_values, (counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _format_labels(self.labels + ('le',), label_values + (bound,))
+                    lines.append(f'{self.name}_bucket{labels} {bucket_count}')
+                labels = _format_labels(self.labels + ('le',), label_values + ('+Inf',))
+                lines.append(f'{self.name}_bucket{labels} {count}')
+                labels = _format_labels(self.labels, label_values)
+                lines.append(f'{self.name}_sum{labels} {total}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+stage_seconds = Histogram('pipeline_stage_seconds', 'Time spent in each pipeline stage', ('stage',))
+request_seconds = Histogram('http_request_seconds', 'HTTP request latency', ('path', 'status'))
+requests_in_flight = Gauge('http_requests_in_flight', 'HTTP requests currently being served')
+upload_bytes = Histogram('upload_bytes', 'Size of uploaded images', buckets=BYTES_BUCKETS)
+image_pixels = Histogram('image_pixels', 'Pixel count of uploaded images before downscaling',
+                         buckets=PIXELS_BUCKETS)
+cache_lookups = Counter('result_cache_lookups_total', 'Result cache lookups', ('result',))
+
+# Metrics that live elsewhere are read when /metrics is scraped
+_collectors = []
+
+
+def register_collector(fn):
+    """fn returns a list of Prometheus text lines"""
+    _collectors.append(fn)
+    return fn
+
+
+def render_metrics():
+    lines = []
+    for metric in (stage_seconds, request_seconds, requests_in_flight, upload_bytes, image_pixels, cache_lookups):
+        lines.extend(metric.render())
+    for collector in _collectors:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
+
+
+_local = threading.local()
+
+
+@contextmanager
+def stage(name):
+    """Times one pipeline stage, for the current request if one is being collected"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('stage', name, time.perf_counter() - started)
+
+
+def observe(metric, label, value):
+    collected = getattr(_local, 'collected', None)
+    if collected is not None:
+        collected.append((metric, label, value))
+    else:
+        record_observations([(metric, label, value)])
+
+
+def record_observations(observations):
+    # Runs in the API process, so worker processes report through their return value
+    for metric, label, value in observations:
+        if metric == 'stage':
+            stage_seconds.observe(label, value=value)
+        elif metric == 'image_pixels':
+            image_pixels.observe(value=value)
+
+
+def run_collected(fn, *args, profile=False, **kwargs):
+    """Runs fn, returning (result, observations, profile text or None)"""
+    _local.collected = []
+    profiler = cProfile.Profile() if profile else None
+    try:
+        if profiler:
+            profiler.enable()
+        try:
+            result = fn(*args, **kwargs)
+        finally:
+            if profiler:
+                profiler.disable()
+        return result, _local.collected, _profile_text(profiler) if profiler else None
+    finally:
+        _local.collected = None
+
+
+def _profile_text(profiler, limit=40):
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+
+def server_timing(observations):
+    return ', '.join(f'{label};dur={value * 1000:.1f}' for metric, label, value in observations if metric == 'stage')
+
+
+class RequestMetricsMiddleware():
+    """Counts and times HTTP requests until the last body chunk is sent, so a streamed
+    response such as the NDJSON batch is measured in full and not only until its headers"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        requests_in_flight.inc(amount=1)
+        started = time.perf_counter()
+        status = 500
+        finished = False
+
+        def finish():
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            requests_in_flight.inc(amount=-1)
+            # Route templates keep the label set small, unknown paths share one label
+            route = scope.get("route")
+            request_seconds.observe(getattr(route, "path", "unmatched"), status, value=time.perf_counter() - started)
+
+        async def timed_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finish()
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            # Errors, and clients that went away before the body was complete
+            finish()
+
+
+class ProfileSampler():
+    """Decides which requests get profiled; the rate can be changed while running"""
+
+    def __init__(self, rate=PROFILE_SAMPLE_RATE, keep=PROFILE_KEEP):
+        self.rate = rate
+        self.profiles = deque(maxlen=keep)
+
+    def should_profile(self):
+        return self.rate > 0 and random.random() < self.rate
+
+    def add(self, path, text):
+        self.profiles.append({"path": path, "time": time.time(), "stats": text})
+
+
+profile_sampler = ProfileSampler()
@@ -0,0 +1,136 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'cloudinary')
+STORAGE_ASYNC = os.getenv('STORAGE_ASYNC', '0') == '1'
+STORAGE_UPLOAD_WORKERS = int(os.getenv('STORAGE_UPLOAD_WORKERS', 4))
+STORAGE_POOL_SIZE = int(os.getenv('STORAGE_POOL_SIZE', 10))
+STORAGE_MAX_RETRIES = int(os.getenv('STORAGE_MAX_RETRIES', 3))
+STORAGE_MAX_JOBS = int(os.getenv('STORAGE_MAX_JOBS', 10000))
+STORAGE_LOCAL_DIR = os.getenv('STORAGE_LOCAL_DIR', 'storage')
+STORAGE_PUBLIC_BASE_URL = os.getenv('STORAGE_PUBLIC_BASE_URL', '/storage')
+
+logger = logging.getLogger(__name__)
+
+
+class CloudinaryStorage():
+    """Uploads to Cloudinary over one shared pool of keep-alive connections"""
+
+    def __init__(self, pool_size=STORAGE_POOL_SIZE):
+        import cloudinary.uploader
+        import cloudinary.utils
+        from config.cloudinaryConfig import cloudinary
+        self.cloudinary = cloudinary
+        # The SDK keeps a single small module-level pool, size it for our upload workers. Built the
+        # way the SDK builds its own, so the configured api_proxy and certificates still apply.
+        cloudinary.uploader._http = cloudinary.utils.get_http_connector(
+            cloudinary.config(), {**cloudinary.CERT_KWARGS, "maxsize": pool_size, "block": True})
+
+    def url_for(self, public_id):
+        url, _ = self.cloudinary.utils.cloudinary_url(public_id, secure=True, resource_type="image", format="png")
+        return url
+
+    def save(self, data, public_id):
+        result = self.cloudinary.uploader.upload(data, public_id=public_id, overwrite=True, resource_type="image")
+        return result['secure_url']
+
+
+class LocalStorage():
+    """Writes images to a local directory, stands in for Cloudinary offline"""
+
+    def __init__(self, directory=STORAGE_LOCAL_DIR, base_url=STORAGE_PUBLIC_BASE_URL):
+        self.directory = directory
+        self.base_url = base_url.rstrip('/')
+        os.makedirs(directory, exist_ok=True)
+
+    def url_for(self, public_id):
+        return f'{self.base_url}/{public_id}.png'
+
+    def save(self, data, public_id):
+        path = os.path.join(self.directory, f'{public_id}.png')
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return self.url_for(public_id)
+
+
+BACKENDS = {
+    'cloudinary': CloudinaryStorage,
+    'local': LocalStorage,
+}
+
+
+class ImageStore():
+    """Front for a storage backend, optionally finishing uploads in the background"""
+
+    def __init__(self, backend, async_uploads=STORAGE_ASYNC, workers=STORAGE_UPLOAD_WORKERS,
+                 max_retries=STORAGE_MAX_RETRIES):
+        self.backend = backend
+        self.async_uploads = async_uploads
+        self.max_retries = max_retries
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload') if async_uploads else None
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _save_with_retries(self, data, public_id):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.backend.save(data, public_id)
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning("Upload of %s failed, retry %d", public_id, attempt + 1, exc_info=True)
+                time.sleep(min(2 ** attempt * 0.5, 8))
+
+    def upload(self, data, public_id=None):
+        """Returns {"url": ...}, plus a "job_id" when the upload finishes in the background"""
+        public_id = public_id or str(uuid.uuid4())
+        if not self.async_uploads:
+            return {"url": self._save_with_retries(data, public_id)}
+
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = {"status": "pending", "public_id": public_id}
+        future = self._pool.submit(self._save_with_retries, data, public_id)
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        return {"url": self.backend.url_for(public_id), "job_id": job_id}
+
+    def _finish(self, job_id, future):
+        with self._lock:
+            job = self._jobs[job_id]
+            if future.exception() is None:
+                job["status"] = "done"
+                job["url"] = future.result()
+            else:
+                job["status"] = "failed"
+                job["error"] = str(future.exception())
+            # Forget the oldest finished jobs so the table stays bounded
+            while len(self._jobs) > STORAGE_MAX_JOBS:
+                oldest_id, oldest = next(iter(self._jobs.items()))
+                if oldest["status"] == "pending":
+                    break
+                del self._jobs[oldest_id]
+
+    def job(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def pending(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job["status"] == "pending")
+
+    def shutdown(self, wait=True):
+        if self._pool:
+            self._pool.shutdown(wait=wait)
+
+
+image_store = ImageStore(BACKENDS[STORAGE_BACKEND]())
@@ -0,0 +1,82 @@
+import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+# Encoders get their own threads: they block while the client is slow, and must never hold the
+# default executor that to_thread work (decoding, token checks) and the event loop rely on
+STREAM_ENCODER_WORKERS = int(os.getenv('STREAM_ENCODER_WORKERS', os.cpu_count() or 1))
+
+_END = object()
+
+encoder_pool = ThreadPoolExecutor(max_workers=STREAM_ENCODER_WORKERS, thread_name_prefix='encoder')
+
+
+class ChunkWriter():
+    """File-like sink an encoder writes into from a worker thread while the response streams the chunks.
+    Chunks are handed to the event loop as they are written; writes block once max_chunks are
+    waiting there, and fail once the client has gone."""
+
+    def __init__(self, loop, max_chunks=8):
+        self._loop = loop
+        self._chunks = asyncio.Queue()
+        # Counts the free places, taken by the writer thread and given back by the consumer
+        self._space = threading.Semaphore(max_chunks)
+        self.closed = False
+
+    def _put(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._chunks.put_nowait, item)
+        except RuntimeError:
+            # The loop is gone, so is the response
+            self.closed = True
+
+    def write(self, data):
+        while not self.closed:
+            if self._space.acquire(timeout=0.1):
+                self._put(bytes(data))
+                return len(data)
+        raise BrokenPipeError("Response stream was closed")
+
+    def flush(self):
+        pass
+
+    def _end(self, error=None):
+        if not self.closed:
+            self._put((_END, error))
+
+    async def _next(self):
+        chunk = await self._chunks.get()
+        self._space.release()
+        return chunk
+
+
+async def stream_encoded(encode, *args, max_chunks=8):
+    """Runs encode(writer, *args) on an encoder thread and yields what it writes, as it writes it"""
+    writer = ChunkWriter(asyncio.get_running_loop(), max_chunks)
+
+    def run():
+        if writer.closed:
+            # The client left while this was waiting for an encoder thread
+            return
+        try:
+            encode(writer, *args)
+        except Exception as e:
+            writer._end(e)
+        else:
+            writer._end()
+
+    encoder_pool.submit(run)
+    try:
+        while True:
+            chunk = await writer._next()
+            if isinstance(chunk, tuple) and chunk[0] is _END:
+                if chunk[1] is not None:
+                    raise chunk[1]
+                return
+            yield chunk
+    finally:
+        # Also reached when the client disconnects, which stops the encoder at its next write
+        writer.closed = True
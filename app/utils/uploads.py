@@ -0,0 +1,157 @@
+import os
+import mmap
+from io import BytesIO
+from PIL import Image
+from dotenv import load_dotenv
+
+load_dotenv()
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', 20 * 1024 * 1024))
+BATCH_MAX_UPLOAD_BYTES = int(os.getenv('BATCH_MAX_UPLOAD_BYTES', 512 * 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 40_000_000))
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Pillow refuses to decode anything above this, on top of our own header check
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'BM', 'BMP'),
+)
+
+
+class UploadError(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def sniff_format(header):
+    """Image format from the first bytes of a file, None when unsupported"""
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'WEBP'
+    for signature, name in SIGNATURES:
+        if header.startswith(signature):
+            return name
+    return None
+
+
+def check_image(data):
+    """Rejects unsupported formats and oversized images from the header alone"""
+    header = bytes(data[:16])
+    image_format = sniff_format(header)
+    if image_format is None:
+        raise UploadError(415, "Unsupported image format, send JPEG, PNG, WebP or BMP")
+    try:
+        # Opening only parses the header, pixels are not decoded here
+        with Image.open(BytesIO(data) if isinstance(data, bytes) else _rewound(data)) as image:
+            width, height = image.size
+    except Image.DecompressionBombError:
+        raise UploadError(413, f"Image is larger than {MAX_IMAGE_PIXELS} pixels")
+    except Exception:
+        raise UploadError(400, "Could not read image header")
+    if width * height > MAX_IMAGE_PIXELS:
+        raise UploadError(413, f"Image is larger than {MAX_IMAGE_PIXELS} pixels")
+    return image_format
+
+
+def _rewound(fileobj):
+    fileobj.seek(0)
+    return fileobj
+
+
+async def read_upload(upload, max_bytes=MAX_UPLOAD_BYTES):
+    """Returns the upload as bytes when small, or as a read-only mmap of its spool file.
+    Both work with decode_image and content_key without another copy."""
+    header = await upload.read(16)
+    if sniff_format(header) is None:
+        raise UploadError(415, "Unsupported image format, send JPEG, PNG, WebP or BMP")
+    upload.file.seek(0, os.SEEK_END)
+    size = upload.file.tell()
+    if size > max_bytes:
+        raise UploadError(413, f"Upload is larger than {max_bytes} bytes")
+    # Starlette already spooled large bodies to a temporary file, map it instead of reading it
+    if getattr(upload.file, '_rolled', False) and size:
+        data = mmap.mmap(upload.file.fileno(), size, access=mmap.ACCESS_READ)
+    else:
+        await upload.seek(0)
+        chunks = []
+        while True:
+            chunk = await upload.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        data = b''.join(chunks)
+    check_image(data)
+    if not isinstance(data, bytes):
+        data.seek(0)
+    return data
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class UploadLimitMiddleware():
+    """Rejects request bodies over the limit for their path while they are still streaming in"""
+
+    def __init__(self, app, limits=None, default=MAX_UPLOAD_BYTES):
+        self.app = app
+        # (path prefix, max bytes), first match wins
+        self.limits = limits or []
+        self.default = default
+
+    def limit_for(self, path):
+        for prefix, limit in self.limits:
+            if path.startswith(prefix):
+                return limit
+        return self.default
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in ("GET", "HEAD", "OPTIONS"):
+            return await self.app(scope, receive, send)
+        limit = self.limit_for(scope["path"])
+        # Allow a little room for the multipart framing around the file
+        limit += 64 * 1024
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            return await self._reject(send)
+
+        received = 0
+        too_large = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    too_large = True
+                    raise BodyTooLarge()
+            return message
+
+        async def limited_send(message):
+            nonlocal response_started
+            if too_large:
+                # The framework may turn the aborted body into its own error, answer 413 instead
+                if not response_started:
+                    response_started = True
+                    await self._reject(send)
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, limited_send)
+        except BodyTooLarge:
+            if not response_started:
+                await self._reject(send)
+
+    async def _reject(self, send):
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": b'{"detail":"Request body too large"}'})
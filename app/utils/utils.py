@@ -1,6 +1,20 @@
 import os
 import jwt
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from configparser import ConfigParser
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPBearer
+
+JWKS_TTL = float(os.getenv("JWKS_TTL", 600))
+# Unknown kids trigger a refetch, but not more often than this
+JWKS_MIN_REFETCH_INTERVAL = float(os.getenv("JWKS_MIN_REFETCH_INTERVAL", 30))
+CLAIMS_CACHE_TTL = float(os.getenv("CLAIMS_CACHE_TTL", 60))
+CLAIMS_CACHE_SIZE = int(os.getenv("CLAIMS_CACHE_SIZE", 10000))
 
 
 def set_up():
@@ -22,33 +36,159 @@ def set_up():
     return config
 
 
+@lru_cache(maxsize=1)
+def get_config():
+    """Reads the configuration once per process"""
+    return dict(set_up())
+
+
+class JWKSCache():
+    """Process-wide signing keys by kid, refreshed in the background once stale"""
+
+    def __init__(self, jwks_url, ttl=JWKS_TTL, min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL, fetch=None):
+        self.jwks_url = jwks_url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.fetch = fetch or jwt.PyJWKClient(jwks_url, cache_jwk_set=False).fetch_data
+        self._keys = {}
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self.fetches = 0
+
+    def refresh(self):
+        data = self.fetch()
+        keys = {jwk.key_id: jwk.key for jwk in jwt.PyJWKSet.from_dict(data).keys}
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+            self.fetches += 1
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            # Keep serving the stale keys, the next lookup tries again
+            pass
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def get_signing_key(self, kid):
+        with self._lock:
+            key = self._keys.get(kid)
+            age = time.monotonic() - self._fetched_at
+            stale = age > self.ttl
+            start_refresh = key is not None and stale and not self._refreshing
+            if start_refresh:
+                self._refreshing = True
+        if start_refresh:
+            threading.Thread(target=self._refresh_in_background, name="jwks-refresh", daemon=True).start()
+        if key is not None:
+            return key
+        # Unknown kid, the keys may have rotated
+        if self._fetched_at and age < self.min_refetch_interval:
+            raise jwt.exceptions.PyJWKClientError(f'Unable to find a signing key that matches: "{kid}"')
+        self.refresh()
+        with self._lock:
+            key = self._keys.get(kid)
+        if key is None:
+            raise jwt.exceptions.PyJWKClientError(f'Unable to find a signing key that matches: "{kid}"')
+        return key
+
+
+class ClaimsCache():
+    """Verified payloads by token hash, never kept past the token's exp"""
+
+    def __init__(self, ttl=CLAIMS_CACHE_TTL, max_entries=CLAIMS_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        key = self.key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            payload, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def set(self, token, payload):
+        expires_at = time.time() + self.ttl
+        if "exp" in payload:
+            expires_at = min(expires_at, float(payload["exp"]))
+        with self._lock:
+            self._entries[self.key(token)] = (payload, expires_at)
+            self._entries.move_to_end(self.key(token))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+token_auth_scheme = HTTPBearer()
+_jwks_caches = {}
+_jwks_caches_lock = threading.Lock()
+claims_cache = ClaimsCache()
+
+
+def get_jwks_cache(config):
+    jwks_url = f'https://{config["DOMAIN"]}/.well-known/jwks.json'
+    with _jwks_caches_lock:
+        if jwks_url not in _jwks_caches:
+            _jwks_caches[jwks_url] = JWKSCache(jwks_url)
+        return _jwks_caches[jwks_url]
+
+
 class VerifyToken():
     """Does all the token verification using PyJWT"""
 
-    def __init__(self, token, permissions=None, scopes=None):
+    def __init__(self, token, permissions=None, scopes=None, config=None, jwks_cache=None, claims=claims_cache):
         self.token = token
         self.permissions = permissions
         self.scopes = scopes
-        self.config = set_up()
+        self.config = config or get_config()
 
-        # This gets the JWKS from a given URL and does processing so you can use any of
-        # the keys available
-        jwks_url = f'https://{self.config["DOMAIN"]}/.well-known/jwks.json'
-        self.jwks_client = jwt.PyJWKClient(jwks_url)
+        # Keys come from one cache per JWKS URL shared by the whole process
+        self.jwks_cache = jwks_cache or get_jwks_cache(self.config)
+        self.claims = claims
 
     def verify(self):
+        payload = self.claims.get(self.token) if self.claims else None
+        if payload is None:
+            payload = self._decode()
+            if payload.get("status") == "error":
+                return payload
+            if self.claims:
+                self.claims.set(self.token, payload)
+        return self._check_permissions(payload)
+
+    async def verify_async(self):
+        # Cached tokens are checked inline, only a key fetch goes to a thread
+        if self.claims and self.claims.get(self.token) is not None:
+            return self.verify()
+        return await asyncio.to_thread(self.verify)
+
+    def _decode(self):
         # This gets the 'kid' from the passed token
         try:
-            self.signing_key = self.jwks_client.get_signing_key_from_jwt(
-                self.token
-            ).key
+            kid = jwt.get_unverified_header(self.token).get("kid")
+            self.signing_key = self.jwks_cache.get_signing_key(kid)
         except jwt.exceptions.PyJWKClientError as error:
             return {"status": "error", "msg": error.__str__()}
         except jwt.exceptions.DecodeError as error:
             return {"status": "error", "msg": error.__str__()}
 
         try: 
-            payload = jwt.decode(
+            return jwt.decode(
                 self.token,
                 self.signing_key,
                 algorithms=self.config["ALGORITHMS"],
@@ -56,26 +196,27 @@ class VerifyToken():
                 issuer=self.config["ISSUER"],
             )
         except Exception as e:
-            return {"status": "error", "message": str(e)}
+            return {"status": "error", "msg": str(e)}
 
+    def _check_permissions(self, payload):
         if self.scopes:
             result = self._check_claims(payload, 'scope', str, self.scopes.split(' '))
-            if result.get("error"):
+            if result.get("status") == "error":
                 return result
 
         if self.permissions:
             result = self._check_claims(payload, 'permissions', list, self.permissions)
-            if result.get("error"):
+            if result.get("status") == "error":
                 return result
 
         return payload
 
     def _check_claims(self, payload, claim_name, claim_type, expected_value):
 
-        instance_check = isinstance(payload[claim_name], claim_type)
+        instance_check = isinstance(payload.get(claim_name), claim_type)
         result = {"status": "success", "status_code": 200}
 
-        payload_claim = payload[claim_name]
+        payload_claim = payload.get(claim_name)
 
         if claim_name not in payload or not instance_check:
             result["status"] = "error"
@@ -98,3 +239,11 @@ class VerifyToken():
                                   "access to this resource")
                 return result
         return result
+
+
+async def requires_auth(credentials=Depends(token_auth_scheme)):
+    """FastAPI dependency that returns the verified token payload"""
+    result = await VerifyToken(credentials.credentials).verify_async()
+    if result.get("status") == "error":
+        raise HTTPException(status_code=result.get("status_code", 401), detail=result.get("msg"))
+    return result
@@ -1,17 +1,40 @@
 import sys
 import os
-from fastapi import FastAPI, HTTPException, File, UploadFile
-from fastapi.responses import JSONResponse
+import asyncio
+from typing import List, Dict, Optional
+from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, File, UploadFile, Header
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from io import BytesIO
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.staticfiles import StaticFiles
 
 
-from app.api.recognize_clothe_and_color import process_and_annotate_image  
+from app.api.recognize_clothe_and_color import detector
+from app.api.matching import OutfitEngine
+from app.api.similarity import get_wardrobe_index
+from app.api.batch import collect_items, stream_batch, BatchTooLargeError
+from app.api.pipeline import recognize_cached
+from app.models.background_removal import resolve_model_name, UnknownModelError
+from app.utils.cache import result_cache
+from app.utils.metrics import (render_metrics, register_collector, server_timing, profile_sampler,
+                               RequestMetricsMiddleware, upload_bytes)
+from app.models.registry import model_registry, MODEL_LOAD_MODE
+from app.utils.executor import pipeline_executor, QueueFullError, RETRY_AFTER_SECONDS
+from app.utils.inference_pool import inference_pool
+from app.utils.storage import image_store, LocalStorage, STORAGE_PUBLIC_BASE_URL
+from app.utils.uploads import (read_upload, UploadError, UploadLimitMiddleware, MAX_UPLOAD_BYTES,
+                               BATCH_MAX_UPLOAD_BYTES)
 
 
 app = FastAPI()
 
+# Oversized bodies are cut off while streaming in, before the multipart parser spools them.
+# Added before CORS so CORS wraps it and its 413 carries the CORS headers
+app.add_middleware(UploadLimitMiddleware, default=MAX_UPLOAD_BYTES,
+                   limits=[("/recognize-clothes-and-colors/batch/", BATCH_MAX_UPLOAD_BYTES)])
+
 # Allow all origins
 app.add_middleware(
     CORSMiddleware,
@@ -21,12 +44,232 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN')
+
+
+# Outermost, so the time includes the other middleware and streamed bodies until their last chunk
+app.add_middleware(RequestMetricsMiddleware)
+
+
+@register_collector
+def service_metrics():
+    queue = pipeline_executor.stats()
+    batching = detector.stats()
+    return [
+        '# TYPE pipeline_pending gauge', f'pipeline_pending {queue["pending"]}',
+        '# TYPE pipeline_queued gauge', f'pipeline_queued {queue["queued"]}',
+        '# TYPE detector_batches_total counter', f'detector_batches_total {batching["batches"]}',
+        '# TYPE detector_batch_items_total counter', f'detector_batch_items_total {batching["items"]}',
+        '# TYPE uploads_pending gauge', f'uploads_pending {image_store.pending()}',
+    ]
+
+
+# With gunicorn --preload this runs once in the master, workers share the weights copy-on-write.
+# With an inference pool the models only live in its workers.
+if MODEL_LOAD_MODE == 'preload' and not inference_pool.enabled:
+    model_registry.load_all(fork_safe_only=True)
+
+# Serve the local storage backend so its URLs resolve without Cloudinary
+if isinstance(image_store.backend, LocalStorage):
+    app.mount(STORAGE_PUBLIC_BASE_URL, StaticFiles(directory=image_store.backend.directory), name="storage")
+
+
+@app.on_event("startup")
+async def load_models():
+    if inference_pool.enabled:
+        # Workers load and warm up the models themselves, /readyz reports them
+        inference_pool.start()
+    elif pipeline_executor.kind == 'process':
+        # Inference only runs in the pool's workers, each loads and warms up in its initializer
+        pipeline_executor.start_workers()
+    elif MODEL_LOAD_MODE in ('startup', 'preload'):
+        # Load and warm up off the event loop so /healthz answers meanwhile
+        asyncio.get_running_loop().run_in_executor(None, model_registry.warmup_all)
+
+
+@app.get("/healthz")
+async def liveness():
+    return JSONResponse(content={"status": "ok"})
+
+
+@app.get("/readyz")
+async def readiness():
+    if inference_pool.enabled:
+        status = inference_pool.status()
+    elif pipeline_executor.kind == 'process':
+        status = pipeline_executor.status()
+    else:
+        status = model_registry.status()
+    return JSONResponse(content=status, status_code=200 if status["ready"] else 503)
+
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    pipeline_executor.shutdown(wait=False)
+    inference_pool.shutdown()
+    # Let background uploads finish before the worker exits
+    image_store.shutdown(wait=True)
+
+
+@app.get("/queue")
+async def queue_status():
+    stats = pipeline_executor.stats()
+    if inference_pool.enabled:
+        stats["inference"] = inference_pool.stats()
+    return JSONResponse(content=stats)
+
+
+@app.get("/detector/stats")
+async def detector_stats():
+    return JSONResponse(content=detector.stats())
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return JSONResponse(content=result_cache.stats())
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+def check_debug_token(token):
+    # Debug endpoints only exist when DEBUG_TOKEN is configured
+    if not DEBUG_TOKEN or token != DEBUG_TOKEN:
+        raise HTTPException(status_code=404)
+
+
+@app.put("/debug/profiling")
+async def set_profiling(rate: float, x_debug_token: str = Header(None)):
+    check_debug_token(x_debug_token)
+    if not 0 <= rate <= 1:
+        raise HTTPException(status_code=400, detail="rate must be between 0 and 1")
+    profile_sampler.rate = rate
+    return JSONResponse(content={"rate": profile_sampler.rate})
+
+
+@app.get("/debug/profiles")
+async def get_profiles(x_debug_token: str = Header(None)):
+    check_debug_token(x_debug_token)
+    return JSONResponse(content={"rate": profile_sampler.rate, "profiles": list(profile_sampler.profiles)})
+
+
+@app.get("/uploads/{job_id}")
+async def upload_status(job_id: str):
+    job = image_store.job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown upload job")
+    return JSONResponse(content=job)
+
 
 @app.post("/recognize-clothes-and-colors/")
-async def recognize_clothes_and_colors(file: UploadFile = File(...)):
+async def recognize_clothes_and_colors(file: UploadFile = File(...), bg_model: str = None, annotate: bool = False):
+    if bg_model:
+        try:
+            resolve_model_name(bg_model)
+        except UnknownModelError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    try:
+        input_image_bytes = await read_upload(file)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    upload_bytes.observe(value=len(input_image_bytes))
     try:
-        input_image_bytes = await file.read()
-        result = process_and_annotate_image(input_image_bytes)
-        return JSONResponse(content=result)
+        result, observations, hit = await recognize_cached(input_image_bytes, bg_model, annotate, wait_when_full=False,
+                                                           path="/recognize-clothes-and-colors/")
+    except QueueFullError:
+        raise HTTPException(status_code=503, detail="Server is busy, try again later",
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+    headers = {"X-Cache": "HIT" if hit else "MISS"}
+    if observations:
+        headers["Server-Timing"] = server_timing(observations)
+    return JSONResponse(content=result, headers=headers)
+
+
+
+@app.post("/recognize-clothes-and-colors/batch/")
+async def recognize_clothes_and_colors_batch(files: List[UploadFile] = File(...), bg_model: str = None,
+                                             annotate: bool = False):
+    if bg_model:
+        try:
+            resolve_model_name(bg_model)
+        except UnknownModelError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    try:
+        # Reading files and unpacking zips is blocking work, keep it off the event loop
+        items = await asyncio.to_thread(collect_items, [(f.filename, f.file) for f in files])
+    except BatchTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return StreamingResponse(stream_batch(items, bg_model, annotate), media_type="application/x-ndjson")
+
+
+class OutfitRequest(BaseModel):
+    # {category: {subcategory: [{item_id: [hex colors]}]}}
+    wardrobe: Dict[str, Dict[str, List[Dict[str, List[str]]]]]
+    count: int = 2
+    soft_colors: bool = False
+    seed: Optional[int] = None
+
+
+@app.post("/match-outfit/")
+async def match_outfit(request: OutfitRequest):
+    if not 1 <= request.count <= 50:
+        raise HTTPException(status_code=400, detail="count must be between 1 and 50")
+    try:
+        engine = OutfitEngine(request.wardrobe)
+        outfits = engine.generate(request.count, soft_colors=request.soft_colors, seed=request.seed)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content={"outfits": outfits})
+
+
+class WardrobeItem(BaseModel):
+    # Same fields as an item from /recognize-clothes-and-colors/, plus the caller's id
+    item_id: str
+    label: Optional[str] = None
+    color_palette: List[str]
+    color_weights: Optional[List[float]] = None
+    embedding: Optional[List[float]] = None
+
+
+class WardrobeItems(BaseModel):
+    items: List[WardrobeItem]
+
+
+class SimilarRequest(BaseModel):
+    label: Optional[str] = None
+    color_palette: List[str]
+    color_weights: Optional[List[float]] = None
+    embedding: Optional[List[float]] = None
+    k: int = 10
+    same_label: bool = False
+    exclude_id: Optional[str] = None
+    # e.g. 0.95 to only get likely duplicates
+    min_score: Optional[float] = None
+
+
+@app.post("/wardrobe/items")
+async def add_wardrobe_items(request: WardrobeItems):
+    index = get_wardrobe_index()
+    try:
+        added = await asyncio.to_thread(index.add_many, [item.dict() for item in request.items])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content={"added": added, "size": len(index)})
+
+
+@app.post("/wardrobe/similar")
+async def similar_wardrobe_items(request: SimilarRequest):
+    if not 1 <= request.k <= 100:
+        raise HTTPException(status_code=400, detail="k must be between 1 and 100")
+    index = get_wardrobe_index()
+    try:
+        results = await asyncio.to_thread(index.similar, request.label, request.color_palette, request.color_weights,
+                                          request.embedding, request.k, request.same_label, request.exclude_id,
+                                          request.min_score)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content={"results": results})
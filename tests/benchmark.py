@@ -0,0 +1,240 @@
+"""Offline benchmark of the recognition pipeline.
+
+Runs every stage in-process against data/sample_images and synthetic photos,
+with Cloudinary replaced by the local storage backend and, unless --real-models
+is given, YOLO and rembg replaced by cheap stubs. Prints (or writes) JSON:
+
+    python -m tests.benchmark --concurrency 1,4,8 --requests 64 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import glob
+import argparse
+import platform
+import tempfile
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SYNTHETIC_SIZES = [(640, 480), (1920, 1080), (4032, 3024)]
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    values = np.asarray(samples) * 1000.0
+    return {
+        "count": len(samples),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+
+def synthetic_image(width, height, seed=0):
+    """A garment-like blob on a noisy background, encoded as JPEG"""
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(180, 255, size=(height, width, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels)
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((width // 4, height // 6, width * 3 // 4, height * 5 // 6), fill=(30, 60, 140))
+    draw.rectangle((width * 2 // 5, height // 3, width * 3 // 5, height * 2 // 3), fill=(200, 40, 40))
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def load_inputs():
+    inputs = []
+    for path in sorted(glob.glob(os.path.join(base_dir, 'data', 'sample_images', '*'))):
+        with open(path, 'rb') as f:
+            inputs.append((os.path.basename(path), f.read()))
+    for i, (width, height) in enumerate(SYNTHETIC_SIZES):
+        inputs.append((f'synthetic_{width}x{height}.jpg', synthetic_image(width, height, seed=i)))
+    return inputs
+
+
+class StubTensor():
+    def __init__(self, array):
+        self.array = array
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+
+class StubBoxes():
+    def __init__(self, array):
+        self.data = StubTensor(array)
+
+
+class StubResult():
+    def __init__(self, width, height):
+        box = [width * 0.2, height * 0.1, width * 0.8, height * 0.9, 0.9, 0]
+        self.boxes = StubBoxes(np.array([box], dtype=np.float32))
+
+
+class StubDetector():
+    """Answers like an ultralytics YOLO model with one centered box per image"""
+    names = {0: 'stub-garment'}
+
+    def __init__(self, delay_ms=0.0):
+        self.delay = delay_ms / 1000.0
+
+    def __call__(self, images, **kwargs):
+        batch = images if isinstance(images, list) else [images]
+        if self.delay:
+            time.sleep(self.delay)
+        return [StubResult(*image.size) for image in batch]
+
+
+def stub_remove_background(image, model=None, **kwargs):
+    """Keeps an ellipse in the middle of the image as foreground"""
+    mask = Image.new('L', image.size, 0)
+    width, height = image.size
+    ImageDraw.Draw(mask).ellipse((width // 5, height // 10, width * 4 // 5, height * 9 // 10), fill=255)
+    cutout = image.convert('RGBA')
+    cutout.putalpha(mask)
+    return cutout
+
+
+def setup_pipeline(real_models, stub_delay_ms):
+    os.environ.setdefault('STORAGE_BACKEND', 'local')
+    os.environ.setdefault('STORAGE_LOCAL_DIR', tempfile.mkdtemp(prefix='bench-storage-'))
+    os.environ.setdefault('COLOR_URI', os.path.join(base_dir, 'data', 'colors.csv'))
+    os.environ.setdefault('MODEL_LOAD_MODE', 'lazy')
+    sys.path.insert(0, base_dir)
+    from app.api import recognize_clothe_and_color as pipeline
+    from app.models.registry import model_registry
+    if not real_models:
+        model_registry.register('detector', lambda: StubDetector(stub_delay_ms))
+        model_registry.register('background_removal', lambda: stub_remove_background)
+        pipeline.remove_background = stub_remove_background
+    model_registry.load_all()
+    return pipeline
+
+
+def timed(fn, *args, **kwargs):
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def bench_stages(pipeline, inputs, repeats):
+    """Runs each stage on its own, in pipeline order, and records its latency.
+    Stages that work per detected item (crop, rembg, palette, encode, upload) record one sample per item."""
+    from app.utils.ingest import decode_image
+    stages = {name: [] for name in ('decode', 'yolo', 'crop', 'rembg', 'palette', 'encode', 'upload')}
+    per_input = {}
+    for name, data in inputs:
+        input_stages = {stage: [] for stage in stages}
+        for i in range(repeats):
+            image, seconds = timed(decode_image, data)
+            input_stages['decode'].append(seconds)
+            # Detection runs on the whole photo, everything after it on each item's crop
+            items, seconds = timed(pipeline.find_items, image)
+            input_stages['yolo'].append(seconds)
+            for j, item in enumerate(items):
+                crop, seconds = timed(pipeline.crop_item, image, item["box"])
+                input_stages['crop'].append(seconds)
+                cutout, seconds = timed(pipeline.remove_background, crop)
+                input_stages['rembg'].append(seconds)
+                _, seconds = timed(pipeline.extract_color_palette, cutout)
+                input_stages['palette'].append(seconds)
+                buffer = BytesIO()
+                _, seconds = timed(cutout.save, buffer, format="PNG")
+                input_stages['encode'].append(seconds)
+                _, seconds = timed(pipeline.upload_image, buffer.getvalue(), public_id=f'bench-{name}-{i}-{j}')
+                input_stages['upload'].append(seconds)
+        per_input[name] = {"bytes": len(data), **{stage: percentiles(v) for stage, v in input_stages.items()}}
+        for stage, samples in input_stages.items():
+            stages[stage].extend(samples)
+    return {stage: percentiles(samples) for stage, samples in stages.items()}, per_input
+
+
+def bench_end_to_end(pipeline, inputs, concurrency, requests):
+    latencies = []
+
+    def one_request(i):
+        _, data = inputs[i % len(inputs)]
+        _, seconds = timed(pipeline.process_and_annotate_image, data)
+        latencies.append(seconds)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one_request, range(requests)))
+    elapsed = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 3),
+        "latency": percentiles(latencies),
+    }
+
+
+def bench_token_verification(runs=1000):
+    """Per-call latency of VerifyToken with cold and cached claims, against a local key set"""
+    from tests.test_verify_token import CONFIG, local_jwks, make_token
+    from app.utils.utils import VerifyToken, JWKSCache, ClaimsCache
+    cache = JWKSCache("https://bench.local/.well-known/jwks.json", fetch=local_jwks())
+    token = make_token()
+    cold, cached = [], []
+    claims = ClaimsCache()
+    for _ in range(runs):
+        _, seconds = timed(VerifyToken(token, config=CONFIG, jwks_cache=cache, claims=ClaimsCache()).verify)
+        cold.append(seconds)
+        _, seconds = timed(VerifyToken(token, config=CONFIG, jwks_cache=cache, claims=claims).verify)
+        cached.append(seconds)
+    return {"full_verification": percentiles(cold), "cached_claims": percentiles(cached)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', default='1,4,8', help='comma separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=32, help='requests per concurrency level')
+    parser.add_argument('--repeats', type=int, default=3, help='per-stage repetitions per input')
+    parser.add_argument('--real-models', action='store_true', help='use YOLO and rembg instead of stubs')
+    parser.add_argument('--stub-delay-ms', type=float, default=0.0, help='simulated detector latency')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    pipeline = setup_pipeline(args.real_models, args.stub_delay_ms)
+    inputs = load_inputs()
+    # One untimed pass so lazy initialisation does not land in the numbers
+    pipeline.process_and_annotate_image(inputs[0][1])
+
+    stages, per_input = bench_stages(pipeline, inputs, args.repeats)
+    report = {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "real_models": args.real_models,
+        "inputs": [name for name, _ in inputs],
+        "stages": stages,
+        "stages_per_input": per_input,
+        "end_to_end": [bench_end_to_end(pipeline, inputs, int(c), args.requests)
+                       for c in args.concurrency.split(',')],
+        "detector_batching": pipeline.detector.stats(),
+        "token_verification": bench_token_verification(),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import json
+import time
+import asyncio
+import jwt
+from jwt.algorithms import RSAAlgorithm
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from app.utils.utils import VerifyToken, JWKSCache, ClaimsCache
+
+CONFIG = {
+    "DOMAIN": "tests.local",
+    "API_AUDIENCE": "mycloset-api",
+    "ISSUER": "https://tests.local/",
+    "ALGORITHMS": "RS256",
+}
+
+private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def local_jwks(kid="test-key"):
+    """Stands in for https://DOMAIN/.well-known/jwks.json and counts fetches"""
+    jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update(kid=kid, use="sig", alg="RS256")
+
+    def fetch():
+        fetch.calls += 1
+        return {"keys": [jwk]}
+    fetch.calls = 0
+    return fetch
+
+
+def make_token(kid="test-key", expires_in=3600, **claims):
+    payload = {"sub": "user-1", "aud": CONFIG["API_AUDIENCE"], "iss": CONFIG["ISSUER"],
+               "exp": int(time.time()) + expires_in, **claims}
+    return jwt.encode(payload, private_key, algorithm="RS256", headers={"kid": kid})
+
+
+def verifier(token, fetch, claims=None, **kwargs):
+    cache = JWKSCache("https://tests.local/.well-known/jwks.json", fetch=fetch)
+    return cache, lambda: VerifyToken(token, config=CONFIG, jwks_cache=cache,
+                                      claims=claims if claims is not None else ClaimsCache(), **kwargs)
+
+
+def test_jwks_is_fetched_once_for_many_verifications():
+    fetch = local_jwks()
+    cache = JWKSCache("https://tests.local/.well-known/jwks.json", fetch=fetch)
+    for _ in range(20):
+        # A fresh claims cache each time forces full signature verification
+        payload = VerifyToken(make_token(), config=CONFIG, jwks_cache=cache, claims=ClaimsCache()).verify()
+        assert payload["sub"] == "user-1"
+    assert fetch.calls == 1
+
+
+def test_cached_claims_skip_verification(monkeypatch):
+    fetch = local_jwks()
+    claims = ClaimsCache()
+    _, build = verifier(make_token(), fetch, claims=claims)
+    assert build().verify()["sub"] == "user-1"
+
+    decode_calls = []
+    real_decode = jwt.decode
+    monkeypatch.setattr(jwt, "decode", lambda *args, **kwargs: decode_calls.append(1) or real_decode(*args, **kwargs))
+    for _ in range(100):
+        assert build().verify()["sub"] == "user-1"
+    # Neither the signature nor the key set are looked at again while the claims are cached
+    assert decode_calls == []
+    assert fetch.calls == 1
+
+
+def test_claims_cache_respects_exp():
+    claims = ClaimsCache(ttl=60)
+    claims.set("token", {"sub": "user-1", "exp": time.time() - 1})
+    assert claims.get("token") is None
+
+
+def test_expired_token_is_rejected():
+    _, build = verifier(make_token(expires_in=-10), local_jwks())
+    result = build().verify()
+    assert result["status"] == "error"
+
+
+def test_unknown_kid_refetch_is_rate_limited():
+    fetch = local_jwks()
+    _, build = verifier(make_token(), fetch)
+    build().verify()
+    for _ in range(5):
+        token = make_token(kid="rotated-key")
+        result = VerifyToken(token, config=CONFIG, jwks_cache=build().jwks_cache, claims=ClaimsCache()).verify()
+        assert result["status"] == "error"
+    assert fetch.calls == 1
+
+
+def test_scopes_are_checked_on_cached_claims():
+    claims = ClaimsCache()
+    token = make_token(scope="read:items")
+    _, build = verifier(token, local_jwks(), claims=claims)
+    assert build().verify()["scope"] == "read:items"
+    result = VerifyToken(token, scopes="write:items", config=CONFIG,
+                         jwks_cache=build().jwks_cache, claims=claims).verify()
+    assert result["status_code"] == 403
+
+
+def test_verify_async_uses_cache():
+    fetch = local_jwks()
+    _, build = verifier(make_token(), fetch)
+    first = asyncio.run(build().verify_async())
+    second = asyncio.run(build().verify_async())
+    assert first == second
+    assert fetch.calls == 1